@@ -0,0 +1,168 @@
+# app/benchmark.py
+"""Offline recall/latency benchmark for the vector index configurations.
+
+Runs entirely on FAISS, standing in for the Milvus index types in
+indexes.py, so it needs neither a Milvus server nor the models:
+
+    python benchmark.py --n 200000 --dims 768 1024 1152 --k 10
+    python benchmark.py --data embeddings.npy --indexes HNSW IVF_PQ
+
+DISKANN has no FAISS equivalent and is skipped.
+"""
+import argparse
+import json
+import time
+
+import faiss
+import numpy as np
+
+from indexes import INDEX_PRESETS
+
+# Search-time knob values swept for each index family
+SWEEPS = {
+    "FLAT": [None],
+    "IVF_FLAT": [1, 8, 32, 128],
+    "IVF_SQ8": [1, 8, 32, 128],
+    "IVF_PQ": [1, 8, 32, 128],
+    "HNSW": [16, 64, 256],
+}
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def synthetic(n: int, dim: int, n_queries: int, seed: int = 0) -> tuple[np.ndarray, np.ndarray]:
+    # Clustered data is closer to real embeddings than iid noise, and much harder for IVF
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((max(16, n // 1000), dim)).astype(np.float32)
+    def sample(count):
+        points = centers[rng.integers(0, len(centers), count)]
+        return normalize(points + 0.5 * rng.standard_normal((count, dim)).astype(np.float32))
+    return sample(n), sample(n_queries)
+
+
+def load(path: str, n_queries: int, seed: int = 0) -> tuple[np.ndarray, np.ndarray]:
+    vectors = normalize(np.load(path).astype(np.float32))
+    rng = np.random.default_rng(seed)
+    order = rng.permutation(len(vectors))
+    return vectors[order[n_queries:]], vectors[order[:n_queries]]
+
+
+def largest_divisor(dim: int, at_most: int) -> int:
+    return max(m for m in range(1, at_most + 1) if dim % m == 0)
+
+
+def build(index_type: str, params: dict, data: np.ndarray):
+    dim = data.shape[1]
+    metric = faiss.METRIC_INNER_PRODUCT  # cosine on normalized vectors
+    if index_type == "FLAT":
+        index = faiss.IndexFlatIP(dim)
+    elif index_type.startswith("IVF"):
+        # k-means wants ~39 points per centroid
+        nlist = max(1, min(params["nlist"], len(data) // 39))
+        quantizer = faiss.IndexFlatIP(dim)
+        if index_type == "IVF_FLAT":
+            index = faiss.IndexIVFFlat(quantizer, dim, nlist, metric)
+        elif index_type == "IVF_SQ8":
+            index = faiss.IndexIVFScalarQuantizer(quantizer, dim, nlist, faiss.ScalarQuantizer.QT_8bit, metric)
+        else:
+            index = faiss.IndexIVFPQ(quantizer, dim, nlist, largest_divisor(dim, params["m"]), params["nbits"], metric)
+        index.train(data)
+    elif index_type == "HNSW":
+        index = faiss.IndexHNSWFlat(dim, params["M"], metric)
+        index.hnsw.efConstruction = params["efConstruction"]
+    else:
+        raise ValueError(f"{index_type} has no FAISS stand-in")
+    index.add(data)
+    return index
+
+
+def set_knob(index, index_type: str, value):
+    if value is None:
+        return
+    if index_type == "HNSW":
+        index.hnsw.efSearch = value
+    else:
+        index.nprobe = value
+
+
+def recall_at_k(found: np.ndarray, truth: np.ndarray) -> float:
+    k = truth.shape[1]
+    return float(np.mean([len(set(f) & set(t)) / k for f, t in zip(found, truth)]))
+
+
+def run(index_type: str, data: np.ndarray, queries: np.ndarray, truth: np.ndarray, k: int) -> list[dict]:
+    params = INDEX_PRESETS[index_type]
+    start = time.perf_counter()
+    index = build(index_type, params, data)
+    build_seconds = time.perf_counter() - start
+    memory_bytes = len(faiss.serialize_index(index))
+
+    rows = []
+    for value in SWEEPS[index_type]:
+        set_knob(index, index_type, value)
+        # Throughput with the whole query set in one call
+        start = time.perf_counter()
+        _, found = index.search(queries, k)
+        qps = len(queries) / (time.perf_counter() - start)
+        # Latency one query at a time, as the API serves them
+        latencies = []
+        for query in queries:
+            start = time.perf_counter()
+            index.search(query[None, :], k)
+            latencies.append((time.perf_counter() - start) * 1000)
+        rows.append({
+            "index_type": index_type,
+            "dim": data.shape[1],
+            "n": len(data),
+            "knob": value,
+            "build_s": round(build_seconds, 3),
+            "memory_mb": round(memory_bytes / 2**20, 1),
+            "qps": round(qps, 1),
+            "p50_ms": round(float(np.percentile(latencies, 50)), 3),
+            "p99_ms": round(float(np.percentile(latencies, 99)), 3),
+            f"recall@{k}": round(recall_at_k(found, truth), 4),
+        })
+    return rows
+
+
+def print_table(rows: list[dict]):
+    columns = list(rows[0].keys())
+    widths = {c: max(len(c), *(len(str(row[c])) for row in rows)) for c in columns}
+    print("  ".join(c.ljust(widths[c]) for c in columns))
+    for row in rows:
+        print("  ".join(str(row[c]).ljust(widths[c]) for c in columns))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark vector index configurations offline")
+    parser.add_argument("--n", type=int, default=100_000, help="Number of base vectors to generate")
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--dims", type=int, nargs="+", default=[768, 1024, 1152], help="CLIP, DINO and SigLIP sizes")
+    parser.add_argument("--data", help="Load vectors from a .npy file instead of generating them")
+    parser.add_argument("--indexes", nargs="+", default=list(SWEEPS), choices=list(INDEX_PRESETS))
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    results = []
+    datasets = [load(args.data, args.queries, args.seed)] if args.data else [
+        synthetic(args.n, dim, args.queries, args.seed) for dim in args.dims
+    ]
+    for data, queries in datasets:
+        print(f"dim={data.shape[1]} n={len(data)} queries={len(queries)}")
+        exact = faiss.IndexFlatIP(data.shape[1])
+        exact.add(data)
+        _, truth = exact.search(queries, args.k)
+        for index_type in args.indexes:
+            if index_type not in SWEEPS:
+                print(f"  skipping {index_type}: no FAISS stand-in")
+                continue
+            results += run(index_type, data, queries, truth, args.k)
+
+    print_table(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
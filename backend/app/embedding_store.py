@@ -0,0 +1,66 @@
+# app/embedding_store.py
+import hashlib
+import sqlite3
+import threading
+from typing import NamedTuple, Optional
+
+import numpy as np
+
+
+def content_hash(contents: bytes) -> str:
+    return hashlib.sha256(contents).hexdigest()
+
+
+class StoredEmbedding(NamedTuple):
+    embedding: np.ndarray
+    image_path: Optional[str]
+
+
+class EmbeddingStore:
+    """Disk-backed embedding cache keyed by (content hash, model id).
+
+    `image_path` is set once the vector has been written to Milvus, so a
+    hit with a path means the upload is already indexed.
+    """
+
+    def __init__(self, path: str = "embedding_cache.db"):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    content_hash TEXT NOT NULL,
+                    model_id TEXT NOT NULL,
+                    embedding BLOB NOT NULL,
+                    image_path TEXT,
+                    PRIMARY KEY (content_hash, model_id)
+                )
+            """)
+
+    def get(self, content_hash: str, model_id: str) -> Optional[StoredEmbedding]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT embedding, image_path FROM embeddings WHERE content_hash = ? AND model_id = ?",
+                (content_hash, model_id)
+            ).fetchone()
+        if row is None:
+            return None
+        return StoredEmbedding(np.frombuffer(row[0], dtype=np.float32), row[1])
+
+    def put(self, content_hash: str, model_id: str, embedding: np.ndarray, image_path: Optional[str] = None):
+        blob = np.asarray(embedding, dtype=np.float32).tobytes()
+        with self._lock, self._conn:
+            self._conn.execute(
+                """
+                INSERT INTO embeddings (content_hash, model_id, embedding, image_path) VALUES (?, ?, ?, ?)
+                ON CONFLICT (content_hash, model_id) DO UPDATE SET
+                    embedding = excluded.embedding,
+                    image_path = COALESCE(excluded.image_path, embeddings.image_path)
+                """,
+                (content_hash, model_id, blob, image_path)
+            )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
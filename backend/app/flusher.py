@@ -0,0 +1,57 @@
+# app/flusher.py
+import asyncio
+import logging
+from typing import Optional
+
+from pymilvus import Collection
+
+from common.metrics import MILVUS_SECONDS
+
+
+class DeferredFlusher:
+    """Flushes a collection on a timer or once enough rows are pending,
+    instead of sealing a segment after every insert."""
+
+    def __init__(self, collection: Optional[Collection], max_pending_rows: int = 1000, interval: float = 5.0):
+        self.collection = collection
+        self.max_pending_rows = max(1, max_pending_rows)
+        self.interval = interval
+        self._pending_rows = 0
+        self._lock: Optional[asyncio.Lock] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._lock = asyncio.Lock()
+            self._task = asyncio.create_task(self._run())
+
+    def record(self, rows: int):
+        self.start()
+        self._pending_rows += rows
+        if self._pending_rows >= self.max_pending_rows:
+            asyncio.create_task(self.flush())
+
+    async def flush(self):
+        async with self._lock:
+            if self._pending_rows == 0 or self.collection is None:
+                return
+            pending, self._pending_rows = self._pending_rows, 0
+            try:
+                with MILVUS_SECONDS.labels("flush").time():
+                    await asyncio.to_thread(self.collection.flush)
+            except Exception as e:
+                # Keep the rows counted so the next tick retries.
+                self._pending_rows += pending
+                logging.error(f"Error flushing {self.collection.name}: {e}")
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._lock is not None:
+            await self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
@@ -0,0 +1,68 @@
+# app/indexes.py
+import json
+import os
+from typing import Optional
+
+# Starting points per index type; MILVUS_INDEX_PARAMS overrides individual keys.
+# IVF_PQ's m has to divide the vector dim (1152 / 48 = 24 values per subvector).
+INDEX_PRESETS = {
+    "FLAT": {},
+    "IVF_FLAT": {"nlist": 1024},
+    "IVF_SQ8": {"nlist": 1024},
+    "IVF_PQ": {"nlist": 1024, "m": 48, "nbits": 8},
+    "HNSW": {"M": 16, "efConstruction": 200},
+    "DISKANN": {},
+}
+
+
+def index_params(index_type: str, params: Optional[dict] = None, metric_type: str = "COSINE") -> dict:
+    index_type = index_type.upper()
+    if index_type not in INDEX_PRESETS:
+        raise ValueError(f"Unsupported index type {index_type}, choose from {list(INDEX_PRESETS)}")
+    merged = dict(INDEX_PRESETS[index_type])
+    merged.update(params or {})
+    return {"metric_type": metric_type, "index_type": index_type, "params": merged}
+
+
+def index_params_from_env(metric_type: str = "COSINE") -> dict:
+    return index_params(
+        os.getenv("MILVUS_INDEX_TYPE", "IVF_FLAT"),
+        json.loads(os.getenv("MILVUS_INDEX_PARAMS", "{}")),
+        metric_type
+    )
+
+
+
+# Server-side caps on what a single search may ask for
+SEARCH_MAX_LIMIT = int(os.getenv("SEARCH_MAX_LIMIT", "200"))
+SEARCH_MAX_OFFSET = int(os.getenv("SEARCH_MAX_OFFSET", "10000"))
+SEARCH_MAX_NPROBE = int(os.getenv("SEARCH_MAX_NPROBE", "128"))
+SEARCH_MAX_EF = int(os.getenv("SEARCH_MAX_EF", "1024"))
+
+
+def index_metric_type(collection, field_name: str = "embedding", default: str = "COSINE") -> str:
+    # The metric the field was indexed with; a search with any other one is rejected
+    for index in collection.indexes:
+        if index.field_name == field_name:
+            return index.params.get("metric_type", default)
+    return default
+
+
+def build_search_params(
+    limit: int,
+    offset: int,
+    nprobe: Optional[int] = None,
+    ef: Optional[int] = None,
+    metric_type: str = "COSINE"
+) -> tuple[dict, int, int]:
+    limit = min(max(1, limit), SEARCH_MAX_LIMIT)
+    offset = min(max(0, offset), SEARCH_MAX_OFFSET)
+    # Each index type only reads its own knob (IVF_*: nprobe, HNSW: ef, DISKANN: search_list),
+    # so send all of them and stay correct across a reindex. ef/search_list must cover the top-k.
+    ef = min(max(ef or 64, limit + offset), max(SEARCH_MAX_EF, limit + offset))
+    params = {
+        "nprobe": min(max(1, nprobe or 10), SEARCH_MAX_NPROBE),
+        "ef": ef,
+        "search_list": ef,
+    }
+    return {"metric_type": metric_type, "params": params}, limit, offset
@@ -1,34 +1,153 @@
 # app/main.py
-from fastapi import FastAPI, File, UploadFile, Form, Request
+from fastapi import FastAPI, File, UploadFile, Form, Request, HTTPException
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse
-from transformers import AutoProcessor, AutoModel
-import torch
+from fastapi.responses import HTMLResponse, JSONResponse, Response
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 from PIL import Image
 import io
-from pymilvus import connections, Collection, utility, DataType
+from pymilvus import Collection, utility, DataType
 import numpy as np
 from typing import Optional
+import asyncio
+import logging
 import os
+import re
+
+from common.batching import MicroBatcher
+from common.errors import InferenceSaturated
+from common.executor import InferenceExecutor
+from common.metrics import BATCH_SIZE, MILVUS_SECONDS, QUEUE_DEPTH, stage
+from common.milvus_pool import get_pool
+from cache import TTLCache
+from embedding_store import EmbeddingStore, content_hash
+from flusher import DeferredFlusher
+from indexes import build_search_params, index_metric_type, index_params_from_env
 
 app = FastAPI()
 templates = Jinja2Templates(directory="templates")
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
-# Initialize CLIP model and processor
-processor = AutoProcessor.from_pretrained("google/siglip-so400m-patch14-384")
-model = AutoModel.from_pretrained("google/siglip-so400m-patch14-384")
-model.eval()
-# Connect to Milvus
-connections.connect(
-    alias="default",
-    host=os.getenv("MILVUS_HOST", "localhost"),
-    port=os.getenv("MILVUS_PORT", "19530")
+# All model forwards run here, off the event loop
+executor = InferenceExecutor(
+    max_workers=int(os.getenv("INFERENCE_MAX_WORKERS", "1")),
+    max_queue=int(os.getenv("INFERENCE_MAX_QUEUE", "64")),
 )
+QUEUE_DEPTH.labels("inference").set_function(lambda: executor.pending)
+
+@app.exception_handler(InferenceSaturated)
+async def inference_saturated(request: Request, exc: InferenceSaturated):
+    return JSONResponse(
+        status_code=503,
+        content={"error": "Inference is saturated, try again later"},
+        headers={"Retry-After": "1"}
+    )
+
+MODEL_ID = "google/siglip-so400m-patch14-384"
+# "torch" runs eager PyTorch, "onnx" runs exported towers through ONNX Runtime
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "torch")
+# With FAST_START the app binds straight away and loads everything in the background
+FAST_START = os.getenv("FAST_START", "1") == "1"
+WARMUP = os.getenv("WARMUP", "1") == "1"
+# Milvus or the model hub may come up after us: retry startup with exponential backoff
+STARTUP_ATTEMPTS = int(os.getenv("STARTUP_ATTEMPTS", "6"))
+STARTUP_BACKOFF_SECONDS = float(os.getenv("STARTUP_BACKOFF_SECONDS", "2"))
+STARTUP_MAX_BACKOFF_SECONDS = float(os.getenv("STARTUP_MAX_BACKOFF_SECONDS", "60"))
+
+# Set by the startup sequence; inference routes answer 503 until it finishes
+processor = None
+model = None
+collection = None
+readiness = {"status": "starting", "error": None}
+
+def load_model():
+    global processor, model
+    # torch and transformers are only imported here so non-inference routes start fast
+    from transformers import AutoProcessor, AutoModel
+
+    processor = AutoProcessor.from_pretrained(MODEL_ID)
+    if INFERENCE_BACKEND == "onnx":
+        from common.onnx_backend import OnnxDualEncoder
+        loaded = OnnxDualEncoder.from_pretrained(
+            lambda: AutoModel.from_pretrained(MODEL_ID),
+            processor,
+            export_dir=os.getenv("ONNX_EXPORT_DIR", "onnx/siglip"),
+            quantize=os.getenv("ONNX_QUANTIZE", "0") == "1",
+            intra_op_threads=int(os.getenv("ORT_INTRA_OP_THREADS", "0")) or None,
+        )
+    else:
+        loaded = AutoModel.from_pretrained(MODEL_ID)
+    model = loaded.eval()
+
+# Shared with anything else in this process that talks to Milvus
+milvus = get_pool(os.getenv("MILVUS_URI") or f"http://{os.getenv('MILVUS_HOST', 'localhost')}:{os.getenv('MILVUS_PORT', '19530')}")
+
+def connect_milvus():
+    global collection
+    milvus.connection()
+    create_collection_if_not_exists()
+    collection = milvus.collection(COLLECTION_NAME)
+    flusher.collection = collection
+
+async def search_collection(**kwargs):
+    # The pool reconnects or reloads and retries once if the channel died
+    # or the collection was released under us
+    with MILVUS_SECONDS.labels("search").time():
+        return await asyncio.to_thread(milvus.retry, COLLECTION_NAME, collection.search, **kwargs)
+
+SEARCHABLE_OUTPUT_FIELDS = {"id", "image_path"}
+
+# reindex.py can switch the collection to an index with another metric under the
+# same name, so the metric is read back from the index, re-checked once a minute
+search_metric_cache = TTLCache(maxsize=1, ttl=float(os.getenv("SEARCH_METRIC_TTL_SECONDS", "60")))
+
+async def get_search_metric():
+    metric_type = search_metric_cache.get(COLLECTION_NAME)
+    if metric_type is None:
+        metric_type = await asyncio.to_thread(milvus.retry, COLLECTION_NAME, index_metric_type, collection)
+        search_metric_cache.set(COLLECTION_NAME, metric_type)
+    return metric_type
+
+def warm_up():
+    # One pass through each tower so the first real request doesn't pay for lazy init
+    get_embeddings([Image.new("RGB", (384, 384))])
+    get_text_embedding("warm up")
+
+async def start():
+    delay = STARTUP_BACKOFF_SECONDS
+    for attempt in range(1, STARTUP_ATTEMPTS + 1):
+        try:
+            # Steps that already succeeded are not redone on a retry
+            if collection is None:
+                readiness["status"] = "connecting"
+                await asyncio.to_thread(connect_milvus)
+            if model is None:
+                readiness["status"] = "loading"
+                await asyncio.to_thread(load_model)
+            if WARMUP:
+                readiness["status"] = "warming"
+                await executor.run(warm_up)
+            readiness["status"] = "ready"
+            readiness["error"] = None
+            return
+        except Exception as e:
+            logging.error(f"Startup attempt {attempt}/{STARTUP_ATTEMPTS} failed: {e}")
+            readiness["error"] = str(e)
+            if attempt == STARTUP_ATTEMPTS:
+                readiness["status"] = "failed"
+                return
+            readiness["status"] = "retrying"
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, STARTUP_MAX_BACKOFF_SECONDS)
+
+def require_ready():
+    if readiness["status"] != "ready":
+        raise HTTPException(status_code=503, detail=f"Model not ready ({readiness['status']})", headers={"Retry-After": "5"})
+
+COLLECTION_NAME = os.getenv("MILVUS_COLLECTION", "image_embeddings")
 
 def create_collection_if_not_exists():
-    collection_name = "image_embeddings"
+    collection_name = COLLECTION_NAME
     dim = 1152  # SIGLIP embedding dimension
     # utility.drop_collection(collection_name)
     if utility.has_collection(collection_name):
@@ -43,22 +162,111 @@ def create_collection_if_not_exists():
     schema = CollectionSchema(fields=fields)
     collection = Collection(name=collection_name, schema=schema)
     
-    # Create index
-    index_params = {
-        "metric_type": "COSINE",
-        "index_type": "IVF_FLAT",
-        "params": {"nlist": 128}
-    }
-    collection.create_index(field_name="embedding", index_params=index_params)
+    # Create index from MILVUS_INDEX_TYPE / MILVUS_INDEX_PARAMS; use reindex.py to change it later
+    collection.create_index(field_name="embedding", index_params=index_params_from_env())
     return collection
 
-collection = create_collection_if_not_exists()
+# Rows become searchable without a flush; flushing only seals segments,
+# so do it in bulk rather than after every insert.
+flusher = DeferredFlusher(
+    None,
+    max_pending_rows=int(os.getenv("FLUSH_MAX_PENDING_ROWS", "1000")),
+    interval=float(os.getenv("FLUSH_INTERVAL_SECONDS", "5")),
+)
+INSERT_CHUNK_SIZE = int(os.getenv("INSERT_CHUNK_SIZE", "256"))
 
-def get_embedding(image):
-    with torch.no_grad():
-        inputs = processor(images=image, return_tensors="pt")
+def get_embeddings(images):
+    import torch
+    BATCH_SIZE.labels("siglip").observe(len(images))
+    with stage("siglip", "preprocess"):
+        inputs = processor(images=images, return_tensors="pt")
+    with stage("siglip", "forward"), torch.no_grad():
         image_features = model.get_image_features(**inputs)
-    return image_features.cpu().detach().numpy()[0].astype(float).tolist()
+    with stage("siglip", "postprocess"):
+        return list(image_features.cpu().numpy().astype(np.float32))
+
+# Concurrent /index and image /search requests share forward passes
+image_batcher = MicroBatcher(
+    get_embeddings,
+    executor,
+    max_batch_size=int(os.getenv("EMBED_MAX_BATCH_SIZE", "16")),
+    max_wait_ms=float(os.getenv("EMBED_MAX_WAIT_MS", "10")),
+    max_queue=int(os.getenv("EMBED_MAX_QUEUE", "256")),
+)
+QUEUE_DEPTH.labels("siglip_batcher").set_function(lambda: image_batcher.queue_depth)
+
+async def get_embedding(image):
+    return await image_batcher.submit(image)
+
+def get_text_embedding(text):
+    import torch
+    with stage("siglip_text", "preprocess"):
+        inputs = processor(text=text, return_tensors="pt", padding=True)
+    with stage("siglip_text", "forward"), torch.no_grad():
+        text_features = model.get_text_features(**inputs)
+    return text_features[0].numpy()
+
+# Popular queries skip the text tower entirely
+text_embedding_cache = TTLCache(
+    maxsize=int(os.getenv("TEXT_CACHE_SIZE", "4096")),
+    ttl=float(os.getenv("TEXT_CACHE_TTL_SECONDS", "3600")),
+)
+
+def normalize_query(text):
+    # The SigLIP tokenizer lowercases, so case and spacing don't change the vector
+    return " ".join(text.split()).lower()
+
+async def get_text_embedding_cached(text):
+    key = (MODEL_ID, normalize_query(text))
+    query_vector = text_embedding_cache.get(key)
+    if query_vector is None:
+        query_vector = await executor.run(get_text_embedding, key[1])
+        text_embedding_cache.set(key, query_vector)
+    return query_vector
+
+# Uploads are keyed by SHA-256 of their bytes, so duplicates reuse the stored vector and row
+embedding_store = EmbeddingStore(os.getenv("EMBEDDING_CACHE_PATH", "embedding_cache.db"))
+# Digests some request is indexing right now. The store only learns of an upload once it
+# is inserted, so without this concurrent copies of the same bytes would all insert a row.
+indexing: dict[str, asyncio.Future] = {}
+
+async def wait_for_indexing(digest):
+    # Waits out whoever is indexing these bytes, then reports what the store has
+    while digest in indexing:
+        await asyncio.shield(indexing[digest])
+    return embedding_store.get(digest, MODEL_ID)
+
+def begin_indexing(digest):
+    # Call with no await since the store lookup, so two requests can't both claim it
+    indexing[digest] = asyncio.get_running_loop().create_future()
+
+def end_indexing(digest):
+    future = indexing.pop(digest, None)
+    if future is not None and not future.done():
+        future.set_result(None)
+
+def decode_upload(contents):
+    return Image.open(io.BytesIO(contents)).convert("RGB")
+
+async def decode_request_image(contents):
+    # Off the event loop; an image PIL can't read is the client's mistake, not a 500
+    try:
+        return await asyncio.to_thread(decode_upload, contents)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Could not decode image: {e}")
+
+def save_upload(contents, digest, filename):
+    # The uploaded bytes as they came: no decode and JPEG re-encode just to store them.
+    # Named by digest, so uploads sharing a name can't overwrite each other and the
+    # client's filename never becomes part of a path; only its extension is kept.
+    extension = os.path.splitext(filename or "")[1].lower()
+    if not re.fullmatch(r"\.[a-z0-9]{1,5}", extension):
+        extension = ""
+    image_path = f"static/uploads/{digest}{extension}"
+    os.makedirs("static/uploads", exist_ok=True)
+    with open(image_path, "wb") as f:
+        f.write(contents)
+    return image_path
 
 
 @app.get("/", response_class=HTMLResponse)
@@ -68,65 +276,235 @@ async def root(request: Request):
         {"request": request}
     )
 
+@app.on_event("startup")
+async def startup():
+    if FAST_START:
+        app.state.startup_task = asyncio.create_task(start())
+    else:
+        await start()
+
+@app.get("/health")
+async def health():
+    # Liveness: unhealthy only once startup has given up, so the orchestrator restarts us
+    failed = readiness["status"] == "failed"
+    content = {
+        "status": "failed" if failed else "ok",
+        "error": readiness["error"],
+        "inference_pending": executor.pending,
+        "batch_queue": image_batcher.queue_depth,
+        "milvus": milvus.stats(),
+    }
+    return JSONResponse(status_code=503 if failed else 200, content=content)
+
+@app.get("/ready")
+async def ready():
+    if readiness["status"] != "ready":
+        return JSONResponse(status_code=503, content=readiness)
+    return readiness
+
+@app.get("/cache/stats")
+async def cache_stats():
+    return {"text_embeddings": text_embedding_cache.stats()}
+
+@app.get("/metrics")
+async def metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
 @app.post("/index")
 async def index_image(image: UploadFile = File(...)):
-    # Read and process image
+    require_ready()
+    # Read and hash before decoding so re-uploads cost nothing
     contents = await image.read()
-    pil_image = Image.open(io.BytesIO(contents))
-    
-    # Generate embedding
-    embedding = get_embedding(pil_image)    
-    # Save image to disk
-    image_path = f"static/uploads/{image.filename}"
-    os.makedirs("static/uploads", exist_ok=True)
-    pil_image.save(image_path)
-    
-    # Insert into Milvus
-    collection.insert([
-        [embedding],      # Ensure embedding is a list of floats within a list
-        [image_path]
-    ])
-    collection.flush()
-    
-    return {"status": "success", "message": "Image indexed successfully"}
+    digest = content_hash(contents)
+    stored = await wait_for_indexing(digest)
+    if stored is not None and stored.image_path:
+        return {"status": "success", "message": "Image already indexed", "image_path": stored.image_path, "duplicate": True}
+
+    begin_indexing(digest)
+    try:
+        # Generate embedding, decoding off the event loop
+        if stored is not None:
+            embedding = stored.embedding
+        else:
+            embedding = await get_embedding(await decode_request_image(contents))
+        # Save image to disk
+        image_path = await asyncio.to_thread(save_upload, contents, digest, image.filename)
+
+        # Insert into Milvus
+        with MILVUS_SECONDS.labels("insert").time():
+            await asyncio.to_thread(collection.insert, [
+                [embedding.tolist()],      # Ensure embedding is a list of floats within a list
+                [image_path]
+            ])
+        flusher.record(1)
+        embedding_store.put(digest, MODEL_ID, embedding, image_path)
+    finally:
+        end_indexing(digest)
+
+    return {"status": "success", "message": "Image indexed successfully", "image_path": image_path}
+
+@app.post("/index/batch")
+async def index_images(images: list[UploadFile] = File(...)):
+    require_ready()
+    results = [None] * len(images)
+
+    async def embed(contents, stored_embedding):
+        if stored_embedding is not None:
+            return stored_embedding
+        # Decoded in a worker thread; the pixels go as soon as the vector is back
+        try:
+            pil_image = await asyncio.to_thread(decode_upload, contents)
+        except Exception as e:
+            raise ValueError(f"Could not decode image: {e}")
+        try:
+            return await get_embedding(pil_image)
+        except Exception as e:
+            raise RuntimeError(f"Embedding failed: {e}")
+
+    # Hash everything first; nothing is decoded yet, so repeats and uploads
+    # already stored never touch the model
+    pending = []
+    first_seen = {}
+    repeats = []
+    # Digests this request claimed, and ones another request was already indexing
+    claimed = []
+    elsewhere = []
+    try:
+        for i, image in enumerate(images):
+            try:
+                contents = await image.read()
+                digest = content_hash(contents)
+                if digest in first_seen:
+                    repeats.append((i, first_seen[digest]))
+                    continue
+                first_seen[digest] = i
+                stored = embedding_store.get(digest, MODEL_ID)
+                if stored is not None and stored.image_path:
+                    results[i] = {"filename": image.filename, "status": "success", "image_path": stored.image_path, "duplicate": True}
+                    continue
+                if digest in indexing:
+                    # Waited on only after our own claims are released: two batches holding
+                    # each other's digests would otherwise wait on each other forever
+                    elsewhere.append((i, digest))
+                    continue
+                begin_indexing(digest)
+                claimed.append(digest)
+                pending.append((i, image.filename, digest, contents, stored.embedding if stored is not None else None))
+            except Exception as e:
+                results[i] = {"filename": image.filename, "status": "error", "message": f"Could not read image: {e}"}
+
+        # The batcher groups these into full forward passes; feed it in windows so
+        # a large upload neither overruns its queue nor holds every image decoded
+        rows = []
+        window = image_batcher.max_batch_size * 4
+        for start in range(0, len(pending), window):
+            chunk = pending[start:start + window]
+            embeddings = await asyncio.gather(
+                *(embed(contents, stored_embedding) for _, _, _, contents, stored_embedding in chunk),
+                return_exceptions=True
+            )
+            for (i, filename, digest, contents, _), embedding in zip(chunk, embeddings):
+                if isinstance(embedding, Exception):
+                    results[i] = {"filename": filename, "status": "error", "message": str(embedding)}
+                    continue
+                try:
+                    rows.append((i, digest, embedding, await asyncio.to_thread(save_upload, contents, digest, filename)))
+                except Exception as e:
+                    results[i] = {"filename": filename, "status": "error", "message": f"Could not save image: {e}"}
+
+        # One insert per chunk, flushed later by the flusher
+        for start in range(0, len(rows), INSERT_CHUNK_SIZE):
+            chunk = rows[start:start + INSERT_CHUNK_SIZE]
+            try:
+                with MILVUS_SECONDS.labels("insert").time():
+                    await asyncio.to_thread(collection.insert, [
+                        [embedding.tolist() for _, _, embedding, _ in chunk],
+                        [image_path for _, _, _, image_path in chunk]
+                    ])
+                flusher.record(len(chunk))
+            except Exception as e:
+                for i, _, _, _ in chunk:
+                    results[i] = {"filename": images[i].filename, "status": "error", "message": f"Insert failed: {e}"}
+                continue
+            for i, digest, embedding, image_path in chunk:
+                embedding_store.put(digest, MODEL_ID, embedding, image_path)
+                results[i] = {"filename": images[i].filename, "status": "success", "image_path": image_path}
+    finally:
+        for digest in claimed:
+            end_indexing(digest)
+
+    for i, digest in elsewhere:
+        stored = await wait_for_indexing(digest)
+        if stored is not None and stored.image_path:
+            results[i] = {"filename": images[i].filename, "status": "success", "image_path": stored.image_path, "duplicate": True}
+        else:
+            results[i] = {"filename": images[i].filename, "status": "error", "message": "Indexing the same image in a concurrent request failed; retry"}
+
+    # Repeats within this request share the outcome of their first copy
+    for i, first in repeats:
+        results[i] = {**results[first], "filename": images[i].filename}
+        if results[i]["status"] == "success":
+            results[i]["duplicate"] = True
+
+    duplicates = sum(1 for result in results if result.get("duplicate"))
+    indexed = sum(1 for result in results if result["status"] == "success") - duplicates
+    return {"indexed": indexed, "duplicates": duplicates, "failed": len(results) - indexed - duplicates, "results": results}
+
+@app.on_event("shutdown")
+async def shutdown():
+    await flusher.close()
+    executor.shutdown()
+    embedding_store.close()
+    milvus.close()
 
 @app.post("/search")
 async def search(
     query_text: str = Form(None),
-    query_image: Optional[UploadFile] = None
+    query_image: Optional[UploadFile] = None,
+    limit: int = Form(5),
+    offset: int = Form(0),
+    nprobe: Optional[int] = Form(None),
+    ef: Optional[int] = Form(None),
+    output_fields: Optional[str] = Form(None)
 ):
+    require_ready()
+    fields = [field.strip() for field in output_fields.split(",") if field.strip()] if output_fields else ["image_path"]
+    unknown = [field for field in fields if field not in SEARCHABLE_OUTPUT_FIELDS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown output fields {unknown}, choose from {sorted(SEARCHABLE_OUTPUT_FIELDS)}")
+
     if query_text:
         # Text-to-image search
-        inputs = processor(text=query_text, return_tensors="pt", padding=True)
-        with torch.no_grad():
-            text_features = model.get_text_features(**inputs)
-        query_vector = text_features[0].numpy()
+        query_vector = await get_text_embedding_cached(query_text)
     elif query_image:
         # Image-to-image search
         contents = await query_image.read()
-        pil_image = Image.open(io.BytesIO(contents))
-        query_vector = get_embedding(pil_image)
+        stored = embedding_store.get(content_hash(contents), MODEL_ID)
+        if stored is not None:
+            query_vector = stored.embedding
+        else:
+            query_vector = await get_embedding(await decode_request_image(contents))
     else:
         return {"error": "Either query text or image must be provided"}
 
     # Search in Milvus
-    collection.load()
-    search_params = {"metric_type": "COSINE", "params": {"nprobe": 10}}
-    results = collection.search(
+    search_params, limit, offset = build_search_params(limit, offset, nprobe, ef, await get_search_metric())
+    results = await search_collection(
         data=[query_vector.tolist()],
         anns_field="embedding",
         param=search_params,
-        limit=5,
-        output_fields=["image_path"]
+        limit=limit,
+        offset=offset,
+        output_fields=fields
     )
 
     # Format results
     search_results = []
     for hits in results:
         for hit in hits:
-            search_results.append({
-                "image_path": hit.entity.get("image_path"),
-                "score": float(hit.score)
-            })
+            result = {field: hit.entity.get(field) for field in fields}
+            result["id"] = hit.id
+            result["score"] = float(hit.score)
+            search_results.append(result)
 
-    return {"results": search_results}
\ No newline at end of file
+    return {"results": search_results, "params": {"limit": limit, "offset": offset, **search_params["params"]}}
@@ -0,0 +1,112 @@
+# app/reindex.py
+"""Rebuild image_embeddings under a new vector index and switch over online.
+
+The rows are copied into a fresh collection that already has the new
+index. The copy is built and loaded, then the collection name is pointed
+at it through a Milvus alias, so the app keeps serving the old index
+until the switch and never sees a dropped collection. The old collection
+is kept (renamed) unless --drop-old is given.
+
+    python reindex.py --index-type HNSW --params '{"M": 32, "efConstruction": 256}'
+"""
+import argparse
+import json
+import os
+import time
+
+from pymilvus import Collection, connections, utility
+
+from indexes import INDEX_PRESETS, index_params
+
+
+def copy_rows(source: Collection, target: Collection, batch_size: int, after_id: int = -1) -> tuple[int, int]:
+    # auto_id primary keys grow monotonically, so "id > after_id" picks up anything written since
+    copied, max_id = 0, after_id
+    iterator = source.query_iterator(
+        batch_size=batch_size,
+        expr=f"id > {after_id}",
+        output_fields=["id", "embedding", "image_path"]
+    )
+    try:
+        while True:
+            rows = iterator.next()
+            if not rows:
+                break
+            target.insert([
+                [row["embedding"] for row in rows],
+                [row["image_path"] for row in rows]
+            ])
+            copied += len(rows)
+            max_id = max(max_id, max(row["id"] for row in rows))
+            print(f"  copied {copied} rows")
+    finally:
+        iterator.close()
+    return copied, max_id
+
+
+def reindex(name: str, new_index: dict, batch_size: int = 1000, drop_old: bool = False) -> str:
+    source = Collection(name)
+    source_name = source.describe()["collection_name"]
+    is_alias = source_name != name
+    suffix = f"{new_index['index_type'].lower()}_{int(time.time())}"
+    target_name = f"{name}_{suffix}"
+
+    print(f"Building {target_name} with {new_index}")
+    target = Collection(target_name, schema=source.schema)
+    target.create_index(field_name="embedding", index_params=new_index)
+
+    source.load()
+    copied, max_id = copy_rows(source, target, batch_size)
+    # Catch up with rows the app wrote while we were copying
+    caught_up, max_id = copy_rows(source, target, batch_size, after_id=max_id)
+    target.flush()
+    utility.wait_for_index_building_complete(target_name, index_name="")
+    target.load()
+    print(f"Copied {copied + caught_up} rows, index built and loaded")
+
+    # Switch the name over to the new collection
+    old_name = source_name
+    if is_alias:
+        utility.alter_alias(target_name, name)
+    else:
+        old_name = f"{name}_old_{int(time.time())}"
+        utility.rename_collection(source_name, old_name)
+        utility.create_alias(target_name, name)
+    print(f"{name} now points at {target_name}")
+
+    # Anything that landed on the old collection during the switch
+    late, _ = copy_rows(Collection(old_name), target, batch_size, after_id=max_id)
+    if late:
+        target.flush()
+        print(f"Copied {late} late rows")
+
+    if drop_old:
+        utility.drop_collection(old_name)
+        print(f"Dropped {old_name}")
+    else:
+        Collection(old_name).release()
+        print(f"Kept {old_name}; drop it once the new index is verified")
+    return target_name
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild the image embedding index without dropping the collection")
+    parser.add_argument("--collection", default=os.getenv("MILVUS_COLLECTION", "image_embeddings"))
+    parser.add_argument("--index-type", required=True, choices=list(INDEX_PRESETS))
+    parser.add_argument("--params", default="{}", help="JSON index params merged over the preset")
+    parser.add_argument("--metric-type", default="COSINE")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--drop-old", action="store_true")
+    args = parser.parse_args()
+
+    connections.connect(
+        alias="default",
+        host=os.getenv("MILVUS_HOST", "localhost"),
+        port=os.getenv("MILVUS_PORT", "19530")
+    )
+    reindex(
+        args.collection,
+        index_params(args.index_type, json.loads(args.params), args.metric_type),
+        batch_size=args.batch_size,
+        drop_old=args.drop_old
+    )
@@ -0,0 +1,38 @@
+import cache
+from cache import TTLCache
+
+
+def test_least_recently_used_is_evicted_first():
+    lru = TTLCache(maxsize=2, ttl=None)
+    lru.set("a", 1)
+    lru.set("b", 2)
+    assert lru.get("a") == 1
+    lru.set("c", 3)
+    assert lru.get("b") is None
+    assert (lru.get("a"), lru.get("c")) == (1, 3)
+
+
+def test_entries_expire(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, "monotonic", lambda: now[0])
+    lru = TTLCache(maxsize=8, ttl=10)
+    lru.set("a", 1)
+    now[0] += 9
+    assert lru.get("a") == 1
+    now[0] += 2
+    assert lru.get("a") is None
+    assert lru.stats()["size"] == 0
+
+
+def test_stats_and_disabled_cache():
+    lru = TTLCache(maxsize=4)
+    lru.set("a", 1)
+    lru.get("a")
+    lru.get("b")
+    assert {key: lru.stats()[key] for key in ("size", "hits", "misses", "hit_rate")} == {
+        "size": 1, "hits": 1, "misses": 1, "hit_rate": 0.5
+    }
+
+    disabled = TTLCache(maxsize=0)
+    disabled.set("a", 1)
+    assert disabled.get("a") is None
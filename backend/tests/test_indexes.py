@@ -0,0 +1,44 @@
+from types import SimpleNamespace
+
+import pytest
+
+from indexes import SEARCH_MAX_EF, SEARCH_MAX_LIMIT, SEARCH_MAX_NPROBE, SEARCH_MAX_OFFSET, build_search_params, index_metric_type, index_params
+
+
+def test_defaults_send_every_index_knob():
+    params, limit, offset = build_search_params(5, 0)
+    assert (limit, offset) == (5, 0)
+    assert params == {"metric_type": "COSINE", "params": {"nprobe": 10, "ef": 64, "search_list": 64}}
+
+
+def test_requests_are_clamped_to_the_caps():
+    params, limit, offset = build_search_params(10**6, 10**7, nprobe=10**6, ef=10**6)
+    assert (limit, offset) == (SEARCH_MAX_LIMIT, SEARCH_MAX_OFFSET)
+    assert params["params"]["nprobe"] == SEARCH_MAX_NPROBE
+    # ef may exceed its cap only as far as it must to cover the requested window
+    assert params["params"]["ef"] == max(SEARCH_MAX_EF, limit + offset)
+
+    params, limit, offset = build_search_params(0, -5, nprobe=-3)
+    assert (limit, offset) == (1, 0)
+    assert params["params"]["nprobe"] == 1
+
+
+def test_ef_covers_offset_plus_limit():
+    params, _, _ = build_search_params(100, 50, ef=16)
+    assert params["params"]["ef"] == params["params"]["search_list"] == 150
+
+
+def test_metric_follows_the_index():
+    collection = SimpleNamespace(indexes=[
+        SimpleNamespace(field_name="other", params={"metric_type": "L2"}),
+        SimpleNamespace(field_name="embedding", params=index_params("HNSW", metric_type="IP")),
+    ])
+    metric_type = index_metric_type(collection)
+    assert metric_type == "IP"
+    assert build_search_params(5, 0, metric_type=metric_type)[0]["metric_type"] == "IP"
+    assert index_metric_type(SimpleNamespace(indexes=[])) == "COSINE"
+
+
+def test_unknown_index_type_is_rejected():
+    with pytest.raises(ValueError):
+        index_params("ANNOY")
@@ -0,0 +1,88 @@
+import io
+import os
+import sys
+
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+from PIL import Image
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    # main mounts static/ and templates/ relative to the working directory
+    monkeypatch.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    monkeypatch.setenv("EMBEDDING_CACHE_PATH", str(tmp_path / "embeddings.db"))
+    sys.modules.pop("main", None)
+    import main
+
+    inserted = []
+
+    class Collection:
+        def insert(self, columns):
+            inserted.extend(columns[1])
+
+    async def get_embedding(image):
+        return np.full(4, image.size[0], dtype=np.float32)
+
+    monkeypatch.setattr(main, "readiness", {"status": "ready", "error": None})
+    monkeypatch.setattr(main, "collection", Collection())
+    monkeypatch.setattr(main, "get_embedding", get_embedding)
+    monkeypatch.setattr(main, "save_upload", lambda contents, digest, filename: f"static/uploads/{digest}.jpg")
+    main.inserted = inserted
+    yield main
+    main.embedding_store.close()
+    sys.modules.pop("main", None)
+
+
+def jpeg(width: int) -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", (width, 8)).save(buffer, "JPEG")
+    return buffer.getvalue()
+
+
+def test_undecodable_uploads_are_a_400(app):
+    client = TestClient(app.app)
+    response = client.post("/index", files={"image": ("bad.jpg", b"not an image")})
+    assert response.status_code == 400
+    response = client.post("/search", files={"query_image": ("bad.jpg", b"not an image")})
+    assert response.status_code == 400
+    assert app.inserted == []
+
+
+def test_index_then_reindex_is_a_duplicate(app):
+    client = TestClient(app.app)
+    first = client.post("/index", files={"image": ("a.jpg", jpeg(16))}).json()
+    second = client.post("/index", files={"image": ("b.jpg", jpeg(16))}).json()
+    assert second["duplicate"] and second["image_path"] == first["image_path"]
+    assert app.inserted == [first["image_path"]]
+
+
+def test_concurrent_duplicates_insert_once(app, monkeypatch):
+    import asyncio
+
+    import httpx
+
+    async def slow_embedding(image):
+        await asyncio.sleep(0.05)
+        return np.full(4, image.size[0], dtype=np.float32)
+
+    monkeypatch.setattr(app, "get_embedding", slow_embedding)
+
+    async def main():
+        transport = httpx.ASGITransport(app=app.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            single = [client.post("/index", files={"image": (f"{n}.jpg", jpeg(16))}) for n in range(3)]
+            # Two batches claiming the same digests in opposite orders must not deadlock
+            batches = [
+                client.post("/index/batch", files=[("images", ("x.jpg", jpeg(24))), ("images", ("y.jpg", jpeg(32)))]),
+                client.post("/index/batch", files=[("images", ("y.jpg", jpeg(32))), ("images", ("x.jpg", jpeg(24)))]),
+            ]
+            return await asyncio.wait_for(asyncio.gather(*single, *batches), 10)
+
+    responses = asyncio.run(main())
+    assert all(response.status_code == 200 for response in responses)
+    assert sorted(app.inserted) == sorted(set(app.inserted))
+    assert len(app.inserted) == 3
+    assert sum(1 for response in responses[:3] if response.json().get("duplicate")) == 2
+    assert [response.json()["duplicates"] for response in responses[3:]] in ([0, 2], [2, 0], [1, 1])
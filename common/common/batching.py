@@ -0,0 +1,103 @@
+# common/batching.py
+import asyncio
+import inspect
+import logging
+from typing import Any, Callable, Optional
+
+from common.errors import InferenceSaturated
+from common.executor import InferenceExecutor
+
+
+class MicroBatcher:
+    """Collects concurrent submissions into batches for a batch function.
+
+    `fn` takes a list of inputs and returns a list of outputs in the same
+    order; an output that is an Exception fails only its own submission.
+    A plain function runs on `executor`. A coroutine function is awaited
+    directly, so it can lease models and use the executor itself (pass
+    no executor then). A batch is dispatched as soon as `max_batch_size`
+    items are waiting or `max_wait_ms` has passed since the first item
+    arrived; submissions beyond `max_queue` waiting items are rejected
+    with InferenceSaturated.
+    """
+
+    def __init__(
+        self,
+        fn: Callable[[list], Any],
+        executor: Optional[InferenceExecutor] = None,
+        max_batch_size: int = 16,
+        max_wait_ms: float = 10,
+        max_queue: int = 256
+    ):
+        if executor is None and not inspect.iscoroutinefunction(fn):
+            raise ValueError("A synchronous batch function needs an executor to run on")
+        self._fn = fn
+        self._executor = executor
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000
+        self.max_queue = max(1, max_queue)
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+
+    def _ensure_worker(self):
+        # The queue and worker are bound to the running loop, so create them lazily.
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def submit(self, item: Any) -> Any:
+        self._ensure_worker()
+        if self._queue.qsize() >= self.max_queue:
+            raise InferenceSaturated(f"{self._queue.qsize()} items already waiting for a batch")
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, future))
+        return await future
+
+    async def _collect(self) -> list:
+        batch = [await self._queue.get()]
+        deadline = asyncio.get_running_loop().time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _call(self, items: list) -> list:
+        if self._executor is None:
+            return await self._fn(items)
+        return await self._executor.run(self._fn, items)
+
+    async def _run(self):
+        while True:
+            batch = await self._collect()
+            batch = [(item, future) for item, future in batch if not future.cancelled()]
+            if not batch:
+                continue
+            try:
+                results = await self._call([item for item, _ in batch])
+            except Exception as e:
+                logging.error(f"Batch of {len(batch)} failed: {e}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    def close(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
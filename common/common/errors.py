@@ -0,0 +1,6 @@
+# common/errors.py
+# Dependency-free so API workers can import it through inference/client.py without the model stack
+
+
+class InferenceSaturated(Exception):
+    pass
@@ -0,0 +1,42 @@
+# common/executor.py
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from common.errors import InferenceSaturated
+
+
+class InferenceExecutor:
+    """Runs blocking model calls on a dedicated thread pool.
+
+    At most `max_workers` calls run at once and at most `max_queue` more
+    may wait; anything beyond that is rejected with InferenceSaturated
+    instead of piling up behind a slow forward pass.
+    """
+
+    def __init__(self, max_workers: int = 1, max_queue: int = 64):
+        self.max_workers = max(1, max_workers)
+        self.max_queue = max(0, max_queue)
+        self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="inference")
+        self._pending = 0
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    @property
+    def saturated(self) -> bool:
+        return self._pending >= self.max_workers + self.max_queue
+
+    async def run(self, fn, *args, **kwargs):
+        if self.saturated:
+            raise InferenceSaturated(f"{self._pending} inference calls already pending")
+        self._pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._pool, partial(fn, *args, **kwargs))
+        finally:
+            self._pending -= 1
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
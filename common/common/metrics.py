@@ -0,0 +1,39 @@
+# common/metrics.py
+from contextlib import contextmanager
+
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+# One set of names for both services so a single dashboard covers them
+
+MODEL_LOADS = Counter("model_loads_total", "Models loaded by ModelManager", ["model"])
+MODEL_UNLOADS = Counter("model_unloads_total", "Models dropped by ModelManager", ["model", "reason"])
+MODEL_LOAD_SECONDS = Histogram(
+    "model_load_seconds", "Time to load a model", ["model"],
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+)
+MODEL_RESIDENT_BYTES = Gauge("model_resident_bytes", "Resident size of loaded models", ["model"])
+INFERENCE_SECONDS = Histogram(
+    "inference_stage_seconds", "Time per inference stage", ["model", "stage"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+)
+BATCH_SIZE = Histogram(
+    "inference_batch_size", "Inputs per model call", ["model"],
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256)
+)
+QUEUE_DEPTH = Gauge("inference_queue_depth", "Work waiting or running", ["queue"])
+MILVUS_SECONDS = Histogram(
+    "milvus_request_seconds", "Milvus call latency", ["operation"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+)
+
+
+@contextmanager
+def stage(model: str, name: str):
+    # Times one of preprocess / forward / postprocess for a model
+    with INFERENCE_SECONDS.labels(model, name).time():
+        yield
+
+
+def serve(port: int):
+    # Standalone /metrics for processes without their own HTTP server
+    start_http_server(port)
@@ -0,0 +1,134 @@
+# common/milvus_pool.py
+import logging
+import os
+import threading
+import time
+from typing import Optional
+
+from pymilvus import Collection, connections, utility
+from pymilvus.client.types import LoadState
+
+
+class MilvusPool:
+    """The process's one Milvus connection, shared by every component.
+
+    pymilvus multiplexes all calls over one gRPC channel per alias, so
+    borrowing the alias is all the pooling a process needs. What the pool
+    adds is ownership: components never connect or disconnect it
+    themselves, a dead channel is noticed and replaced, and each
+    collection is loaded once per process instead of on every
+    construction.
+    """
+
+    def __init__(self, uri: str, alias: str = "default", health_interval: float = 30.0, **connect_kwargs):
+        self.uri = uri
+        self.alias = alias
+        self.health_interval = health_interval
+        self._connect_kwargs = connect_kwargs
+        self._lock = threading.RLock()
+        self._connected = False
+        self._last_check = 0.0
+        self._collections: dict[str, Collection] = {}
+        self._loaded: set[str] = set()
+        self.reconnects = 0
+
+    def _connect(self):
+        connections.connect(self.alias, uri=self.uri, **self._connect_kwargs)
+        self._connected = True
+        self._last_check = time.monotonic()
+
+    def healthy(self) -> bool:
+        try:
+            utility.get_server_version(using=self.alias)
+            return True
+        except Exception as e:
+            logging.warning(f"Milvus health check failed for {self.uri}: {e}")
+            return False
+
+    def connection(self) -> str:
+        # Returns the alias to pass as `using`; checks health at most every health_interval
+        with self._lock:
+            if not self._connected:
+                self._connect()
+            elif time.monotonic() - self._last_check > self.health_interval:
+                if not self.healthy():
+                    self.reconnect()
+                self._last_check = time.monotonic()
+            return self.alias
+
+    def reconnect(self):
+        with self._lock:
+            try:
+                connections.disconnect(self.alias)
+            except Exception:
+                pass
+            # A restarted server has released everything
+            self._loaded.clear()
+            self.reconnects += 1
+            self._connect()
+
+    def collection(self, name: str, load: bool = True) -> Collection:
+        """Borrows a collection handle, loaded unless load=False.
+
+        Handles resolve the connection on every call, so they stay valid
+        across reconnects and can be kept for the life of the caller.
+        """
+        with self._lock:
+            alias = self.connection()
+            collection = self._collections.get(name)
+            if collection is None:
+                collection = self._collections[name] = Collection(name, using=alias)
+            if load and name not in self._loaded:
+                # Loading is idempotent but not free, so ask the server first
+                if utility.load_state(name, using=alias) != LoadState.Loaded:
+                    collection.load()
+                self._loaded.add(name)
+            return collection
+
+    def invalidate(self, name: Optional[str] = None):
+        # Forget cached state for a collection that was dropped, released or re-aliased
+        with self._lock:
+            if name is None:
+                self._collections.clear()
+                self._loaded.clear()
+            else:
+                self._collections.pop(name, None)
+                self._loaded.discard(name)
+
+    def retry(self, name: str, fn, *args, **kwargs):
+        # Runs a call against collection `name`, retrying once after a reconnect if the
+        # channel died, or after a reload if the collection was released under us
+        try:
+            return fn(*args, **kwargs)
+        except Exception:
+            if not self.healthy():
+                self.reconnect()
+            elif utility.load_state(name, using=self.alias) != LoadState.Loaded:
+                self.invalidate(name)
+            else:
+                raise
+            self.collection(name)
+            return fn(*args, **kwargs)
+
+    def stats(self) -> dict:
+        return {"uri": self.uri, "connected": self._connected, "reconnects": self.reconnects, "loaded": sorted(self._loaded)}
+
+    def close(self):
+        with self._lock:
+            if self._connected:
+                connections.disconnect(self.alias)
+                self._connected = False
+            self.invalidate()
+
+
+_pools: dict[str, MilvusPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(uri: Optional[str] = None) -> MilvusPool:
+    # One pool per server; the first takes the "default" alias that bare Collection() calls use
+    uri = uri or os.getenv("MILVUS_URI", "http://localhost:19530")
+    with _pools_lock:
+        if uri not in _pools:
+            _pools[uri] = MilvusPool(uri, alias="default" if not _pools else f"pool-{len(_pools)}")
+        return _pools[uri]
@@ -0,0 +1,197 @@
+# common/onnx_backend.py
+"""ONNX Runtime backend for CLIP-style dual encoders, shared by the backend
+(SigLIP) and inference (CLIP) services. To export and check drift:
+
+    python -m common.onnx_backend --model-id google/siglip-so400m-patch14-384 --export-dir onnx/siglip
+    python -m common.onnx_backend --model-id openai/clip-vit-large-patch14 --export-dir onnx/clip
+"""
+import argparse
+import glob
+import logging
+import os
+from typing import Callable, Optional
+
+import numpy as np
+import onnxruntime as ort
+import torch
+from PIL import Image
+
+
+class _VisionTower(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values):
+        return self.model.get_image_features(pixel_values=pixel_values)
+
+
+class _TextTower(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids):
+        return self.model.get_text_features(input_ids=input_ids)
+
+
+class _MaskedTextTower(_TextTower):
+    def forward(self, input_ids, attention_mask):
+        return self.model.get_text_features(input_ids=input_ids, attention_mask=attention_mask)
+
+
+def tower_paths(export_dir: str, quantize: bool = False) -> dict:
+    suffix = ".int8.onnx" if quantize else ".onnx"
+    return {tower: os.path.join(export_dir, f"{tower}{suffix}") for tower in ("vision", "text")}
+
+
+def export_towers(model, processor, export_dir: str) -> dict:
+    """Exports the vision and text towers of a CLIP-style dual encoder to fp32 ONNX."""
+    os.makedirs(export_dir, exist_ok=True)
+    paths = tower_paths(export_dir)
+    model.eval()
+
+    pixel_values = processor(images=Image.new("RGB", (64, 64)), return_tensors="pt")["pixel_values"]
+    torch.onnx.export(
+        _VisionTower(model), (pixel_values,), paths["vision"],
+        input_names=["pixel_values"], output_names=["image_embeds"],
+        dynamic_axes={"pixel_values": {0: "batch"}, "image_embeds": {0: "batch"}},
+        opset_version=17
+    )
+
+    text_inputs = processor(text=["a photo of a cat"], return_tensors="pt", padding=True)
+    if "attention_mask" in text_inputs:
+        tower, names = _MaskedTextTower(model), ["input_ids", "attention_mask"]
+    else:
+        tower, names = _TextTower(model), ["input_ids"]
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in names}
+    dynamic_axes["text_embeds"] = {0: "batch"}
+    torch.onnx.export(
+        tower, tuple(text_inputs[name] for name in names), paths["text"],
+        input_names=names, output_names=["text_embeds"],
+        dynamic_axes=dynamic_axes,
+        opset_version=17
+    )
+    return paths
+
+
+def quantize_towers(export_dir: str) -> dict:
+    """Applies dynamic int8 weight quantization to exported towers."""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    src, dst = tower_paths(export_dir), tower_paths(export_dir, quantize=True)
+    for tower in src:
+        quantize_dynamic(src[tower], dst[tower], weight_type=QuantType.QInt8, use_external_data_format=True)
+    return dst
+
+
+def session_options(intra_op_threads: Optional[int] = None, inter_op_threads: int = 1) -> ort.SessionOptions:
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    options.intra_op_num_threads = intra_op_threads or os.cpu_count() or 1
+    options.inter_op_num_threads = inter_op_threads
+    return options
+
+
+class OnnxDualEncoder:
+    """ONNX Runtime stand-in for the get_image_features/get_text_features
+    calls of a transformers dual encoder. Takes and returns torch tensors
+    so callers don't need to know which backend they're talking to."""
+
+    def __init__(self, vision_path: str, text_path: str, intra_op_threads: Optional[int] = None):
+        options = session_options(intra_op_threads)
+        self.vision = ort.InferenceSession(vision_path, options, providers=["CPUExecutionProvider"])
+        self.text = ort.InferenceSession(text_path, options, providers=["CPUExecutionProvider"])
+        self._text_inputs = [i.name for i in self.text.get_inputs()]
+        # Weights dominate session memory; count external data files too
+        self.resident_bytes = sum(
+            os.path.getsize(path)
+            for tower in (vision_path, text_path)
+            for path in glob.glob(f"{tower}*")
+        )
+
+    @classmethod
+    def from_pretrained(
+        cls,
+        model_loader: Callable,
+        processor,
+        export_dir: str,
+        quantize: bool = False,
+        intra_op_threads: Optional[int] = None
+    ) -> "OnnxDualEncoder":
+        # Only pay for the torch model when the export has to be (re)built
+        paths = tower_paths(export_dir, quantize)
+        if not all(os.path.exists(path) for path in paths.values()):
+            if not all(os.path.exists(path) for path in tower_paths(export_dir).values()):
+                logging.info(f"Exporting ONNX towers to {export_dir}")
+                export_towers(model_loader(), processor, export_dir)
+            if quantize:
+                logging.info(f"Quantizing ONNX towers in {export_dir}")
+                quantize_towers(export_dir)
+        return cls(paths["vision"], paths["text"], intra_op_threads)
+
+    def eval(self):
+        return self
+
+    def get_image_features(self, pixel_values, **kwargs) -> torch.Tensor:
+        (image_embeds,) = self.vision.run(None, {"pixel_values": np.asarray(pixel_values, dtype=np.float32)})
+        return torch.from_numpy(image_embeds)
+
+    def get_text_features(self, input_ids, attention_mask=None, **kwargs) -> torch.Tensor:
+        feeds = {"input_ids": np.asarray(input_ids, dtype=np.int64)}
+        if "attention_mask" in self._text_inputs:
+            mask = np.ones_like(feeds["input_ids"]) if attention_mask is None else attention_mask
+            feeds["attention_mask"] = np.asarray(mask, dtype=np.int64)
+        (text_embeds,) = self.text.run(None, feeds)
+        return torch.from_numpy(text_embeds)
+
+
+def cosine_drift(reference: np.ndarray, candidate: np.ndarray) -> dict:
+    reference = reference / np.linalg.norm(reference, axis=-1, keepdims=True)
+    candidate = candidate / np.linalg.norm(candidate, axis=-1, keepdims=True)
+    similarity = np.sum(reference * candidate, axis=-1)
+    return {
+        "count": int(similarity.size),
+        "mean_cosine": float(similarity.mean()),
+        "min_cosine": float(similarity.min()),
+        "max_drift": float(1 - similarity.min()),
+    }
+
+
+def check_drift(torch_model, onnx_model: OnnxDualEncoder, processor, images: list, texts: list) -> dict:
+    """Compares ONNX vectors against the fp32 torch model on the same inputs."""
+    report = {}
+    with torch.no_grad():
+        if images:
+            inputs = processor(images=images, return_tensors="pt")
+            report["image"] = cosine_drift(
+                torch_model.get_image_features(**inputs).numpy(),
+                onnx_model.get_image_features(**inputs).numpy()
+            )
+        if texts:
+            inputs = processor(text=texts, return_tensors="pt", padding=True)
+            report["text"] = cosine_drift(
+                torch_model.get_text_features(**inputs).numpy(),
+                onnx_model.get_text_features(**inputs).numpy()
+            )
+    return report
+
+
+if __name__ == "__main__":
+    from transformers import AutoModel, AutoProcessor
+
+    parser = argparse.ArgumentParser(description="Export a dual encoder to ONNX and report drift against fp32 torch")
+    parser.add_argument("--model-id", required=True)
+    parser.add_argument("--export-dir", default=os.getenv("ONNX_EXPORT_DIR"), required=not os.getenv("ONNX_EXPORT_DIR"))
+    parser.add_argument("--quantize", action="store_true")
+    parser.add_argument("--images", nargs="*", default=[])
+    parser.add_argument("--texts", nargs="*", default=["a photo of a dog", "a city skyline at night", "a bowl of fruit"])
+    args = parser.parse_args()
+
+    processor = AutoProcessor.from_pretrained(args.model_id)
+    torch_model = AutoModel.from_pretrained(args.model_id).eval()
+    onnx_model = OnnxDualEncoder.from_pretrained(lambda: torch_model, processor, args.export_dir, args.quantize)
+    images = [Image.open(path).convert("RGB") for path in args.images]
+    for tower, stats in check_drift(torch_model, onnx_model, processor, images, args.texts).items():
+        print(f"{tower}: {stats}")
@@ -0,0 +1,100 @@
+import asyncio
+
+import pytest
+
+from common.batching import MicroBatcher
+from common.errors import InferenceSaturated
+from common.executor import InferenceExecutor
+
+
+def test_concurrent_submissions_share_batches():
+    sizes = []
+
+    async def double(items):
+        sizes.append(len(items))
+        return [item * 2 for item in items]
+
+    async def main():
+        batcher = MicroBatcher(double, max_batch_size=4, max_wait_ms=50)
+        try:
+            return await asyncio.gather(*(batcher.submit(i) for i in range(10)))
+        finally:
+            batcher.close()
+
+    assert asyncio.run(main()) == [i * 2 for i in range(10)]
+    assert sizes == [4, 4, 2]
+
+
+def test_exception_result_fails_only_its_item():
+    async def check(items):
+        return [ValueError(f"bad {item}") if item < 0 else item for item in items]
+
+    async def main():
+        batcher = MicroBatcher(check, max_wait_ms=20)
+        try:
+            return await asyncio.gather(*(batcher.submit(i) for i in (1, -1, 2)), return_exceptions=True)
+        finally:
+            batcher.close()
+
+    ok, bad, other = asyncio.run(main())
+    assert (ok, other) == (1, 2)
+    assert isinstance(bad, ValueError) and str(bad) == "bad -1"
+
+
+def test_raising_batch_fails_every_item():
+    async def broken(items):
+        raise RuntimeError("forward failed")
+
+    async def main():
+        batcher = MicroBatcher(broken, max_wait_ms=20)
+        try:
+            return await asyncio.gather(*(batcher.submit(i) for i in range(3)), return_exceptions=True)
+        finally:
+            batcher.close()
+
+    assert all(isinstance(result, RuntimeError) for result in asyncio.run(main()))
+
+
+def test_full_queue_is_rejected():
+    async def main():
+        release = asyncio.Event()
+
+        async def held(items):
+            await release.wait()
+            return items
+
+        batcher = MicroBatcher(held, max_batch_size=1, max_wait_ms=0, max_queue=2)
+        try:
+            # The first is taken into a batch that blocks; the next two wait in the queue
+            waiting = [asyncio.create_task(batcher.submit(0))]
+            await asyncio.sleep(0.01)
+            waiting += [asyncio.create_task(batcher.submit(i)) for i in (1, 2)]
+            await asyncio.sleep(0.01)
+            assert batcher.queue_depth == 2
+            with pytest.raises(InferenceSaturated):
+                await batcher.submit(3)
+            release.set()
+            return await asyncio.gather(*waiting)
+        finally:
+            batcher.close()
+
+    assert asyncio.run(main()) == [0, 1, 2]
+
+
+def test_sync_function_runs_on_the_executor():
+    with pytest.raises(ValueError):
+        MicroBatcher(lambda items: items)
+
+    executor = InferenceExecutor()
+
+    async def main():
+        batcher = MicroBatcher(lambda items: [len(items)] * len(items), executor, max_wait_ms=20)
+        try:
+            return await asyncio.gather(*(batcher.submit(i) for i in range(3)))
+        finally:
+            batcher.close()
+
+    try:
+        assert asyncio.run(main()) == [3, 3, 3]
+    finally:
+        executor.shutdown()
@@ -0,0 +1,117 @@
+import asyncio
+import io
+import logging
+import os
+from contextlib import AsyncExitStack
+from typing import Optional, Union
+
+import numpy as np
+from PIL import Image, ImageOps
+
+from main import AestheticScorer, ClipEmbedder, ImageTagger, ModelManager, executor
+
+HEADS = ("embedding", "tags", "aesthetic", "faces")
+
+# Largest input any non-face head needs (the tagger's 448 canvas); faces want more detail
+ANALYZE_MAX_SIDE = int(os.getenv("ANALYZE_MAX_SIDE", "448"))
+FACE_MAX_SIDE = int(os.getenv("FACE_MAX_SIDE", "1600"))
+
+
+def decode(source: Union[bytes, str, Image.Image], max_side: Optional[int] = None) -> Image.Image:
+    # The one decode per upload. For JPEGs, draft() lets libjpeg decode straight at a
+    # reduced scale that still covers max_side, which is most of the decode cost saved.
+    if isinstance(source, Image.Image):
+        image = source
+    else:
+        image = Image.open(io.BytesIO(source) if isinstance(source, (bytes, bytearray)) else source)
+        if max_side:
+            image.draft("RGB", (max_side, max_side))
+    image = ImageOps.exif_transpose(image)
+    return image.convert("RGB")
+
+
+def _faces(face_recognizer, bgr: np.ndarray) -> list[dict]:
+    # Every face in the photo, embedded in one batch
+    results, failed = face_recognizer.represent_batch([bgr])
+    if failed:
+        raise RuntimeError("Face detection failed")
+    for face in results[0]:
+        face["identity"] = face_recognizer.match(face["embedding"].tolist())
+    return results[0]
+
+
+async def analyze(
+    source: Union[bytes, str, Image.Image],
+    model_manager: ModelManager,
+    heads: tuple = HEADS,
+    face_recognizer=None,
+    tag_limit: int = 20
+) -> dict:
+    """Decodes an image once and runs the requested heads on the shared pixels.
+
+    heads is any of "embedding", "tags", "aesthetic" and "faces". The
+    aesthetic score reuses the CLIP embedding instead of running CLIP
+    again; faces need a FaceRecognizer from pending.py, and each face's
+    "identity" is the enrolled person it matches (never a discovered
+    cluster id) or None.
+    """
+    unknown = set(heads) - set(HEADS)
+    if unknown:
+        raise ValueError(f"Unknown heads {sorted(unknown)}, choose from {HEADS}")
+    if "faces" in heads and face_recognizer is None:
+        raise ValueError("The faces head needs a face_recognizer")
+
+    # Decoded off the single inference thread so it overlaps with other requests' forwards
+    image = await asyncio.to_thread(decode, source, FACE_MAX_SIDE if "faces" in heads else ANALYZE_MAX_SIDE)
+    result = {"width": image.width, "height": image.height}
+
+    async with AsyncExitStack() as stack:
+        async def embedding_head():
+            clip_embedder = await stack.enter_async_context(model_manager.lease("clip", ClipEmbedder))
+            embedding = await clip_embedder.img2vec(image)
+            if embedding is None:
+                raise RuntimeError("CLIP embedding failed")
+            return embedding
+
+        async def tags_head():
+            tagger = await stack.enter_async_context(model_manager.lease("tagger", ImageTagger))
+            tags, failed = await tagger.predict_batch([image], tag_limit)
+            if failed:
+                raise RuntimeError("Tagging failed")
+            return tags[0]
+
+        async def faces_head():
+            # DeepFace takes BGR arrays, so hand it a flipped view of the shared pixels
+            bgr = np.ascontiguousarray(np.asarray(image)[:, :, ::-1])
+            return await executor.run(_faces, face_recognizer, bgr)
+
+        tasks = {}
+        if "embedding" in heads or "aesthetic" in heads:
+            tasks["embedding"] = embedding_head()
+        if "tags" in heads:
+            tasks["tags"] = tags_head()
+        if "faces" in heads:
+            tasks["faces"] = faces_head()
+        outputs = dict(zip(tasks, await asyncio.gather(*tasks.values(), return_exceptions=True)))
+
+        errors = {}
+        for head, output in outputs.items():
+            if isinstance(output, Exception):
+                logging.error(f"analyze: {head} head failed: {output}")
+                errors[head] = str(output)
+            elif head == "embedding":
+                result["embedding"] = output[0].numpy()
+            else:
+                result[head] = output
+
+        if "aesthetic" in heads and "embedding" in result:
+            scorer = await stack.enter_async_context(model_manager.lease("aesthetic", AestheticScorer))
+            result["aesthetic"] = float((await executor.run(scorer.score_embeddings, result["embedding"][None, :]))[0])
+        elif "aesthetic" in heads:
+            errors["aesthetic"] = "needs the embedding head"
+
+    if "embedding" not in heads:
+        result.pop("embedding", None)
+    if errors:
+        result["errors"] = errors
+    return result
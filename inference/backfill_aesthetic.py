@@ -0,0 +1,56 @@
+import argparse
+import logging
+import os
+import time
+
+import numpy as np
+from pymilvus import Collection
+
+from common.milvus_pool import get_pool
+from main import AestheticScorer
+
+
+def backfill(collection: Collection, scorer: AestheticScorer, batch_size: int = 10000) -> int:
+    # One sweep over the whole library: read stored CLIP image embeddings, score them
+    # through the MLP in one vectorized call per batch and upsert the score back
+    field_names = [field.name for field in collection.schema.fields]
+    if "aesthetic_score" not in field_names:
+        raise RuntimeError(f"{collection.name} has no aesthetic_score field; recreate it with create_embedding_collection()")
+
+    collection.load()
+    iterator = collection.query_iterator(
+        batch_size=batch_size,
+        output_fields=["id", "image_embedding", "text_embedding"]
+    )
+    scored = 0
+    start = time.time()
+    try:
+        while True:
+            rows = iterator.next()
+            if not rows:
+                break
+            scores = scorer.score_embeddings(np.array([row["image_embedding"] for row in rows]))
+            collection.upsert([
+                [row["id"] for row in rows],
+                [row["image_embedding"] for row in rows],
+                [row["text_embedding"] for row in rows],
+                scores.astype(float).tolist()
+            ])
+            scored += len(rows)
+            print(f"Scored {scored} rows ({scored / (time.time() - start):.0f} rows/s)")
+    finally:
+        iterator.close()
+    collection.flush()
+    return scored
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backfill aesthetic scores from stored CLIP embeddings")
+    parser.add_argument("--uri", default=os.getenv("MILVUS_URI", "http://localhost:19530"))
+    parser.add_argument("--collection", default="Embeddings")
+    parser.add_argument("--batch-size", type=int, default=10000)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    total = backfill(get_pool(args.uri).collection(args.collection), AestheticScorer(), args.batch_size)
+    print(f"Backfilled {total} aesthetic scores.")
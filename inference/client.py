@@ -0,0 +1,45 @@
+from typing import Optional
+
+import httpx
+import numpy as np
+
+from common.errors import InferenceSaturated
+
+
+class InferenceClient:
+    """Async client for server.py. Pass `uds` to talk over a Unix socket.
+
+    Raises InferenceSaturated when the server sheds load, so callers can
+    treat a remote model like a local one.
+    """
+
+    def __init__(self, base_url: str = "http://inference", uds: Optional[str] = None, timeout: float = 30.0):
+        transport = httpx.AsyncHTTPTransport(uds=uds) if uds else None
+        self._client = httpx.AsyncClient(base_url=base_url, transport=transport, timeout=timeout)
+
+    async def _post(self, path: str, content: bytes, **params) -> httpx.Response:
+        params = {key: value for key, value in params.items() if value is not None}
+        response = await self._client.post(path, content=content, params=params)
+        if response.status_code == 503:
+            raise InferenceSaturated(response.text)
+        response.raise_for_status()
+        return response
+
+    @staticmethod
+    def _embedding(response: httpx.Response) -> np.ndarray:
+        return np.frombuffer(response.content, dtype="<f4")
+
+    async def img2vec(self, image: bytes) -> np.ndarray:
+        return self._embedding(await self._post("/v1/embed/image", image))
+
+    async def text2vec(self, text: str) -> np.ndarray:
+        return self._embedding(await self._post("/v1/embed/text", text.encode("utf-8")))
+
+    async def aesthetic(self, image: bytes) -> float:
+        return (await self._post("/v1/aesthetic", image)).json()["score"]
+
+    async def tags(self, image: bytes, limit: int = 20, threshold: Optional[float] = None) -> dict:
+        return (await self._post("/v1/tags", image, limit=limit, threshold=threshold)).json()["tags"]
+
+    async def close(self):
+        await self._client.aclose()
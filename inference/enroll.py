@@ -0,0 +1,101 @@
+import argparse
+import logging
+import os
+import time
+
+from pending import FaceRecognizer
+
+PHOTO_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+
+
+def walk(root: str) -> dict[str, list[str]]:
+    # root/identity/*.jpg -> {identity: [paths]}
+    photos = {}
+    for identity in sorted(os.listdir(root)):
+        directory = os.path.join(root, identity)
+        if not os.path.isdir(directory):
+            continue
+        paths = sorted(
+            os.path.join(directory, name) for name in os.listdir(directory)
+            if name.lower().endswith(PHOTO_EXTENSIONS)
+        )
+        if paths:
+            photos[identity] = paths
+    return photos
+
+
+def load_progress(path: str) -> set[str]:
+    if not os.path.exists(path):
+        return set()
+    with open(path) as f:
+        return {line.split("\t", 1)[0] for line in f if line.strip()}
+
+
+def enroll(
+    recognizer: FaceRecognizer,
+    root: str,
+    progress_path: str,
+    identities_per_batch: int = 64,
+    batch_size: int = 64,
+    chunk_size: int = 512
+) -> dict:
+    """Enrolls every identity under root, resuming from progress_path.
+
+    Identities are embedded a group at a time and upserted without
+    flushing; each finished group is appended to the progress file, so an
+    interrupted run picks up at the next group. The collection is flushed
+    once at the end.
+    """
+    photos = walk(root)
+    done = load_progress(progress_path)
+    todo = [identity for identity in photos if identity not in done]
+    print(f"{len(photos)} identities under {root}, {len(done)} already done, {len(todo)} to enroll")
+
+    enrolled, skipped, errored = 0, [], []
+    start = time.time()
+    with open(progress_path, "a") as progress:
+        for group_start in range(0, len(todo), identities_per_batch):
+            group = todo[group_start:group_start + identities_per_batch]
+            templates, missing, failed = recognizer.identity_templates({identity: photos[identity] for identity in group}, batch_size)
+            enrolled += recognizer.add_faces(templates, chunk_size, flush=False)
+            skipped += missing
+            errored += failed
+            # Only written once the upsert went through, so a crash redoes at most this group.
+            # Identities whose photos failed to process stay unrecorded and are retried next run.
+            progress.writelines(
+                [f"{identity}\tenrolled\n" for identity in templates] +
+                [f"{identity}\tno_face\n" for identity in missing]
+            )
+            progress.flush()
+            processed = group_start + len(group)
+            print(f"{processed}/{len(todo)} identities ({processed / (time.time() - start):.1f}/s)")
+
+    if enrolled:
+        recognizer.collection.flush()
+    for identity in skipped:
+        logging.warning(f"No face found for {identity}")
+    for identity in errored:
+        logging.warning(f"Photos of {identity} failed to process; it will be retried on the next run")
+    return {"enrolled": enrolled, "no_face": len(skipped), "failed": len(errored), "already_done": len(done)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk-enroll face identities from root/identity/*.jpg")
+    parser.add_argument("root")
+    parser.add_argument("--uri", default=os.getenv("MILVUS_URI", "http://localhost:19530"))
+    parser.add_argument("--progress", help="Progress file for resuming (default: <root>/.enroll_progress)")
+    parser.add_argument("--identities-per-batch", type=int, default=64)
+    parser.add_argument("--batch-size", type=int, default=64, help="Faces per Facenet512 forward")
+    parser.add_argument("--chunk-size", type=int, default=512, help="Rows per upsert")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    summary = enroll(
+        FaceRecognizer(uri=args.uri),
+        args.root,
+        args.progress or os.path.join(args.root, ".enroll_progress"),
+        args.identities_per_batch,
+        args.batch_size,
+        args.chunk_size,
+    )
+    print(f"Enrollment finished: {summary}")
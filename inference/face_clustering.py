@@ -0,0 +1,376 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import threading
+import uuid
+from typing import Optional
+
+import numpy as np
+from pymilvus import Collection
+
+from pending import CLUSTER_PREFIX, FaceRecognizer
+
+SEARCH_PARAMS = {"metric_type": "IP", "params": {"nprobe": 10}}
+# Milvus caps how many ids fit comfortably in one `id in [...]` expression
+ID_CHUNK = 1000
+# Every read here is read-modify-write of rows this process may have just written;
+# the collections' default Bounded consistency could miss them and double-count faces
+CONSISTENCY = "Strong"
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=-1, keepdims=True), 1e-12)
+
+
+def _two_means(embeddings: np.ndarray, iterations: int = 10) -> tuple[np.ndarray, np.ndarray]:
+    # Spherical 2-means, seeded with the member furthest from the mean and the
+    # member furthest from that one
+    first = embeddings[np.argmin(embeddings @ _normalize(embeddings.mean(axis=0)))]
+    second = embeddings[np.argmin(embeddings @ first)]
+    centers = np.stack([first, second])
+    labels = np.zeros(len(embeddings), dtype=np.int64)
+    for _ in range(iterations):
+        labels = np.argmax(embeddings @ centers.T, axis=1)
+        if labels.min() == labels.max():
+            break
+        updated = _normalize(np.stack([embeddings[labels == k].mean(axis=0) for k in (0, 1)]))
+        if np.allclose(updated, centers):
+            break
+        centers = updated
+    return labels, centers
+
+
+class FaceClusterer:
+    """Groups faces into people as they arrive, without enrollment.
+
+    Centroids live in FaceRecognition next to enrolled identities: ids
+    starting with "cluster-" are discovered clusters, anything else is an
+    enrolled template, which faces can join but which never moves. Every
+    face is stored in Faces with the cluster it joined.
+
+    assign_batch() costs one ANN search per batch of faces. maintain()
+    merges and splits only the clusters that changed since the last pass,
+    again through ANN searches over centroids, so nothing is compared
+    all-pairs however many faces there are.
+    """
+
+    def __init__(
+        self,
+        recognizer: FaceRecognizer,
+        faces: Optional[Collection] = None,
+        join_threshold: float = 0.7,
+        merge_threshold: float = 0.75,
+        split_threshold: float = 0.6,
+        min_split_size: int = 8,
+        split_sample: int = 4096
+    ):
+        self.recognizer = recognizer
+        self.centroids = recognizer.collection
+        self.faces = faces or recognizer.pool.collection("Faces")
+        # Facenet512 cosine similarity; DeepFace's own same-person cutoff is 0.7
+        self.join_threshold = join_threshold
+        self.merge_threshold = merge_threshold
+        self.split_threshold = split_threshold
+        self.min_split_size = min_split_size
+        self.split_sample = split_sample
+        # Assignments and maintenance both read-modify-write centroids
+        self._lock = threading.Lock()
+        self._dirty: set[str] = set()
+        self._task: Optional[asyncio.Task] = None
+
+    def _search_centroids(self, embeddings: np.ndarray, limit: int = 1):
+        return self.centroids.search(
+            data=embeddings.tolist(),
+            anns_field="face_embed",
+            param=SEARCH_PARAMS,
+            limit=limit,
+            output_fields=["face_embed", "member_count"],
+            consistency_level=CONSISTENCY
+        )
+
+    def _fetch_centroids(self, ids) -> dict[str, tuple[np.ndarray, int]]:
+        ids, found = list(ids), {}
+        for start in range(0, len(ids), ID_CHUNK):
+            rows = self.centroids.query(
+                expr=f"id in {json.dumps(ids[start:start + ID_CHUNK])}",
+                output_fields=["id", "face_embed", "member_count"],
+                consistency_level=CONSISTENCY
+            )
+            found.update((row["id"], (np.asarray(row["face_embed"], dtype=np.float32), int(row["member_count"]))) for row in rows)
+        return found
+
+    def _upsert_centroids(self, centroids: dict[str, tuple[np.ndarray, int]]):
+        ids = list(centroids)
+        self.centroids.upsert([
+            ids,
+            [_normalize(centroids[cluster_id][0]).tolist() for cluster_id in ids],
+            [centroids[cluster_id][1] for cluster_id in ids]
+        ])
+
+    def _members(self, cluster_id: str, limit: int = -1):
+        # Yields (face ids, image ids, embeddings) batches for one cluster
+        iterator = self.faces.query_iterator(
+            batch_size=1000,
+            limit=limit,
+            expr=f"cluster_id == {json.dumps(cluster_id)}",
+            output_fields=["id", "image_id", "face_embed"],
+            consistency_level=CONSISTENCY
+        )
+        try:
+            while True:
+                rows = iterator.next()
+                if not rows:
+                    break
+                yield (
+                    [row["id"] for row in rows],
+                    [row["image_id"] for row in rows],
+                    np.asarray([row["face_embed"] for row in rows], dtype=np.float32)
+                )
+        finally:
+            iterator.close()
+
+    def _move_faces(self, face_ids: list, image_ids: list, embeddings: np.ndarray, cluster_id: str):
+        if face_ids:
+            self.faces.upsert([face_ids, image_ids, [cluster_id] * len(face_ids), embeddings.tolist()])
+
+    def assign_batch(self, images: list[tuple[str, list[dict]]]) -> list[list[str]]:
+        """Assigns the faces of many images to clusters.
+
+        images is [(image_id, faces)], with faces as returned by
+        FaceRecognizer.represent_batch. Returns the cluster (or enrolled
+        identity) of every face, per image. Assigning an image again
+        replaces its faces: the old ones leave their clusters first.
+        """
+        rows = [(image_id, n, face["embedding"]) for image_id, faces in images for n, face in enumerate(faces)]
+        face_ids = [f"{image_id}#{n}" for image_id, n, _ in rows]
+
+        with self._lock:
+            sums, stored = self._forget([image_id for image_id, _ in images])
+            cluster_ids = []
+            if rows:
+                embeddings = _normalize(np.stack([np.asarray(embedding, dtype=np.float32) for _, _, embedding in rows]))
+                cluster_ids = self._assign(embeddings, sums)
+                self.faces.upsert([face_ids, [image_id for image_id, _, _ in rows], cluster_ids, embeddings.tolist()])
+            elif sums:
+                self._assign(np.empty((0, 0), dtype=np.float32), sums)
+            # An image that now has fewer faces leaves its old trailing "#n" rows behind
+            stale = sorted(set(stored) - set(face_ids))
+            for start in range(0, len(stale), ID_CHUNK):
+                self.faces.delete(f"id in {json.dumps(stale[start:start + ID_CHUNK])}")
+
+        assigned = iter(cluster_ids)
+        return [[next(assigned) for _ in faces] for _, faces in images]
+
+    def assign(self, image_id: str, faces: list[dict]) -> list[str]:
+        return self.assign_batch([(image_id, faces)])[0]
+
+    def _forget(self, image_ids: list[str]) -> tuple[dict[str, list], list[str]]:
+        # The faces already stored for these images, taken back out of their clusters:
+        # returns running sums for _assign to start from and the stored face ids
+        removed: dict[str, list] = {}
+        stored = []
+        for start in range(0, len(image_ids), ID_CHUNK):
+            rows = self.faces.query(
+                expr=f"image_id in {json.dumps(image_ids[start:start + ID_CHUNK])}",
+                output_fields=["id", "cluster_id", "face_embed"],
+                consistency_level=CONSISTENCY
+            )
+            for row in rows:
+                stored.append(row["id"])
+                # Enrolled templates never move, so only discovered clusters give faces back
+                if row["cluster_id"].startswith(CLUSTER_PREFIX):
+                    total = removed.setdefault(row["cluster_id"], [0, 0])
+                    total[0] = total[0] + np.asarray(row["face_embed"], dtype=np.float32)
+                    total[1] += 1
+        sums = {
+            cluster_id: [centroid * count - removed[cluster_id][0], max(count - removed[cluster_id][1], 0)]
+            for cluster_id, (centroid, count) in self._fetch_centroids(removed).items()
+        }
+        return sums, stored
+
+    def _assign(self, embeddings: np.ndarray, sums: Optional[dict[str, list]] = None) -> list[str]:
+        # Running sums per touched cluster. A stored centroid is normalized, so
+        # centroid * member_count stands in for the sum of its members; clusters in
+        # `sums` (see _forget) start from the given sums instead.
+        sums = dict(sums or {})
+        created: list[str] = []
+        assigned = []
+        for embedding, hits in zip(embeddings, self._search_centroids(embeddings) if len(embeddings) else []):
+            cluster_id = None
+            if hits and hits[0].score >= self.join_threshold:
+                cluster_id = hits[0].id
+                if cluster_id.startswith(CLUSTER_PREFIX) and cluster_id not in sums:
+                    count = int(hits[0].entity.get("member_count"))
+                    sums[cluster_id] = [np.asarray(hits[0].entity.get("face_embed"), dtype=np.float32) * count, count]
+            elif created:
+                # Nothing stored is close; several new faces in one batch may still be one new person
+                scores = [float(_normalize(sums[candidate][0]) @ embedding) for candidate in created]
+                best = int(np.argmax(scores))
+                if scores[best] >= self.join_threshold:
+                    cluster_id = created[best]
+            if cluster_id is None:
+                cluster_id = f"{CLUSTER_PREFIX}{uuid.uuid4().hex}"
+                created.append(cluster_id)
+                sums[cluster_id] = [np.zeros_like(embedding), 0]
+            if cluster_id in sums:
+                sums[cluster_id][0] = sums[cluster_id][0] + embedding
+                sums[cluster_id][1] += 1
+            assigned.append(cluster_id)
+
+        live = {cluster_id: (total, count) for cluster_id, (total, count) in sums.items() if count > 0}
+        if live:
+            self._upsert_centroids(live)
+            self._dirty.update(live)
+        # Clusters whose only faces were re-assigned elsewhere
+        empty = [cluster_id for cluster_id in sums if cluster_id not in live]
+        if empty:
+            self.centroids.delete(f"id in {json.dumps(empty)}")
+            self._dirty.difference_update(empty)
+        return assigned
+
+    def _all_clusters(self) -> set[str]:
+        iterator = self.centroids.query_iterator(
+            batch_size=10000,
+            expr=f'id like "{CLUSTER_PREFIX}%"',
+            output_fields=["id"],
+            consistency_level=CONSISTENCY
+        )
+        ids = set()
+        try:
+            while True:
+                rows = iterator.next()
+                if not rows:
+                    break
+                ids.update(row["id"] for row in rows)
+        finally:
+            iterator.close()
+        return ids
+
+    def _merge(self, centroids: dict[str, tuple[np.ndarray, int]]) -> set[str]:
+        # Each changed cluster looks for its nearest other centroid; close pairs fold
+        # together, into the enrolled identity if one side is enrolled, else into the larger
+        gone = set()
+        order = list(centroids)
+        for start in range(0, len(order), ID_CHUNK):
+            chunk = order[start:start + ID_CHUNK]
+            results = self._search_centroids(np.stack([centroids[cluster_id][0] for cluster_id in chunk]), limit=2)
+            for cluster_id, hits in zip(chunk, results):
+                if cluster_id in gone:
+                    continue
+                for hit in hits:
+                    if hit.id == cluster_id or hit.id in gone or hit.score < self.merge_threshold:
+                        continue
+                    other = centroids.get(hit.id) or (
+                        np.asarray(hit.entity.get("face_embed"), dtype=np.float32), int(hit.entity.get("member_count"))
+                    )
+                    mine = centroids[cluster_id]
+                    if not hit.id.startswith(CLUSTER_PREFIX) or other[1] >= mine[1]:
+                        keep, drop = hit.id, cluster_id
+                        kept, dropped = other, mine
+                    else:
+                        keep, drop = cluster_id, hit.id
+                        kept, dropped = mine, other
+                    for face_ids, image_ids, embeddings in self._members(drop):
+                        self._move_faces(face_ids, image_ids, embeddings, keep)
+                    if keep.startswith(CLUSTER_PREFIX):
+                        centroids[keep] = (kept[0] * kept[1] + dropped[0] * dropped[1], kept[1] + dropped[1])
+                        self._upsert_centroids({keep: centroids[keep]})
+                    self.centroids.delete(f"id in {json.dumps([drop])}")
+                    gone.add(drop)
+                    break
+        return gone
+
+    def _split(self, cluster_id: str, count: int) -> bool:
+        # 2-means on (a sample of) the members; two well-separated halves are two people
+        sample = list(self._members(cluster_id, limit=self.split_sample))
+        embeddings = np.concatenate([batch[2] for batch in sample]) if sample else np.empty((0, 512), dtype=np.float32)
+        if len(embeddings) < self.min_split_size:
+            return False
+        labels, centers = _two_means(embeddings)
+        sizes = np.bincount(labels, minlength=2)
+        if sizes.min() < self.min_split_size // 2 or float(centers[0] @ centers[1]) >= self.split_threshold:
+            if len(embeddings) == count:
+                # Fully read anyway: replace the running mean with the exact one
+                self._upsert_centroids({cluster_id: (embeddings.sum(axis=0), count)})
+            return False
+
+        # Label every member (not just the sample) by the nearer half
+        new_id = f"{CLUSTER_PREFIX}{uuid.uuid4().hex}"
+        totals = [np.zeros(embeddings.shape[1], dtype=np.float32) for _ in (0, 1)]
+        counts = [0, 0]
+        batches = sample if len(embeddings) == count else self._members(cluster_id)
+        for face_ids, image_ids, batch in batches:
+            halves = np.argmax(batch @ centers.T, axis=1)
+            for half in (0, 1):
+                totals[half] += batch[halves == half].sum(axis=0)
+                counts[half] += int((halves == half).sum())
+            moved = np.flatnonzero(halves == 1)
+            self._move_faces([face_ids[i] for i in moved], [image_ids[i] for i in moved], batch[moved], new_id)
+        self._upsert_centroids({cluster_id: (totals[0], counts[0]), new_id: (totals[1], counts[1])})
+        return True
+
+    def maintain(self, full: bool = False) -> dict:
+        """Merges and splits clusters that changed since the last pass (all of them with full)."""
+        with self._lock:
+            changed = self._all_clusters() if full else self._dirty
+            self._dirty = set()
+            centroids = self._fetch_centroids(changed)
+            gone = self._merge(centroids) if centroids else set()
+            split = 0
+            for cluster_id in centroids:
+                if cluster_id not in gone and centroids[cluster_id][1] >= self.min_split_size:
+                    split += self._split(cluster_id, centroids[cluster_id][1])
+        return {"checked": len(centroids), "merged": len(gone), "split": split}
+
+    def images_of(self, cluster_id: str) -> list[str]:
+        # The "people" album for one cluster or enrolled identity
+        images = set()
+        for _, image_ids, _ in self._members(cluster_id):
+            images.update(image_ids)
+        return sorted(images)
+
+    def start(self, interval: float = 600):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(interval))
+
+    async def _run(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                stats = await asyncio.to_thread(self.maintain)
+                logging.info(f"Face cluster maintenance: {stats}")
+            except Exception as e:
+                logging.error(f"Face cluster maintenance failed: {e}")
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cluster the faces in a set of photos into people")
+    parser.add_argument("images", nargs="*", help="Photos to add; their paths are the image ids")
+    parser.add_argument("--uri", default=os.getenv("MILVUS_URI", "http://localhost:19530"))
+    parser.add_argument("--batch-size", type=int, default=32, help="Photos per detection/assignment batch")
+    parser.add_argument("--full", action="store_true", help="Re-check every cluster, not just changed ones")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    recognizer = FaceRecognizer(uri=args.uri)
+    clusterer = FaceClusterer(recognizer)
+    for start in range(0, len(args.images), args.batch_size):
+        paths = args.images[start:start + args.batch_size]
+        results, failed = recognizer.represent_batch(paths)
+        # A failed photo has no faces to report, not zero faces: assigning it [] would
+        # delete whatever was stored for it, so leave it for a later run
+        failed = set(failed)
+        for i in sorted(failed):
+            logging.warning(f"Could not process {paths[i]}; skipped")
+        clusterer.assign_batch([(path, faces) for i, (path, faces) in enumerate(zip(paths, results)) if i not in failed])
+        print(f"Clustered {start + len(paths)}/{len(args.images)} photos")
+    print(f"Maintenance: {clusterer.maintain(full=args.full)}")
+    clusterer.faces.flush()
+    clusterer.centroids.flush()
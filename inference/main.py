@@ -3,67 +3,226 @@ os.environ['TF_ENABLE_ONEDNN_OPTS']='0'
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3' 
 
 import asyncio
+import gc
+import shutil
+import numpy as np
 import torch
 import torch.nn as nn
+from contextlib import asynccontextmanager
+from functools import partial
 from typing import Any, Optional
 from transformers import CLIPModel, CLIPProcessor, CLIPTokenizerFast
+from safetensors.torch import load_file, save_file
 from PIL import Image
 import logging
 import time
 import pytorch_lightning as pl
-import torchvision.transforms.functional as TVF
 import onnxruntime as ort
+from common.errors import InferenceSaturated
+from common.executor import InferenceExecutor
+from common.metrics import (
+    BATCH_SIZE, MODEL_LOAD_SECONDS, MODEL_LOADS, MODEL_RESIDENT_BYTES, MODEL_UNLOADS, QUEUE_DEPTH, serve, stage
+)
+from preprocess_pool import PreprocessPool, SharedBatch, letterbox, normalize
+
+
+executor = InferenceExecutor(
+    max_workers=int(os.getenv("INFERENCE_MAX_WORKERS", "1")),
+    max_queue=int(os.getenv("INFERENCE_MAX_QUEUE", "64")),
+)
+QUEUE_DEPTH.labels("inference").set_function(lambda: executor.pending)
+
+
+def resident_bytes(obj) -> int:
+    # Parameters and buffers of every nn.Module held by the instance. Objects that
+    # aren't plain torch (ONNX sessions) report their own `resident_bytes` instead.
+    if isinstance(getattr(obj, "resident_bytes", None), int):
+        return obj.resident_bytes
+    total, seen = 0, set()
+    for value in vars(obj).values():
+        if isinstance(value, nn.Module):
+            for tensor in list(value.parameters()) + list(value.buffers()):
+                if tensor.data_ptr() not in seen:
+                    seen.add(tensor.data_ptr())
+                    total += tensor.numel() * tensor.element_size()
+        elif isinstance(getattr(value, "resident_bytes", None), int):
+            total += value.resident_bytes
+    return total
 
 
 class ModelManager:
-    def __init__(self, idle_timeout: int = 300):
+    def __init__(self, idle_timeout: int = 300, memory_budget_mb: Optional[int] = None):
         self._models = {}
         self._idle_timeout = idle_timeout
-        self._lock = asyncio.Lock()
+        if memory_budget_mb is None:
+            memory_budget_mb = int(os.getenv("MODEL_MEMORY_BUDGET_MB", "0"))
+        # 0 means no budget, only the idle timeout evicts
+        self._memory_budget = memory_budget_mb * 2**20
+        # One lock per model: a load only blocks requesters of that same model,
+        # and everyone waiting on it reuses the single load instead of repeating it
+        self._load_locks = {}
+        self._leases = {}
+        self._pending_unload = set()
         self._last_access = {}
+        self._sizes = {}
+        # Sizes survive unloads so a reload can make room before it starts
+        self._known_sizes = {}
+        self._metrics = {"loads": 0, "evictions": 0, "evicted_bytes": 0, "idle_unloads": 0}
+        self._load_seconds = {}
         self._cleanup_task = asyncio.create_task(self._cleanup_idle_models())
 
-    async def load(self, model_name: str, model_class):
-        print(f"Loading {model_name}...")
-        async with self._lock:
-            if model_name not in self._models:
+    @property
+    def resident(self) -> int:
+        return sum(self._sizes.values())
+
+    async def _ensure_loaded(self, model_name: str, model_class):
+        # Bookkeeping below never awaits, so it can't interleave with other coroutines
+        while model_name not in self._models:
+            lock = self._load_locks.setdefault(model_name, asyncio.Lock())
+            async with lock:
+                if model_name in self._models:
+                    break
+                print(f"Loading {model_name}...")
+                started = time.perf_counter()
                 try:
-                    self._models[model_name] = await model_class.loader()
-                    self._last_access[model_name] = time.time()
+                    self._evict_to_fit(self._known_sizes.get(model_name, 0), keep=model_name)
+                    model = await model_class.loader()
                 except Exception as e:
                     logging.error(f"Error loading model {model_name}: {e}")
                     raise
-            else:
+                elapsed = time.perf_counter() - started
+                self._models[model_name] = model
+                self._sizes[model_name] = self._known_sizes[model_name] = resident_bytes(model)
                 self._last_access[model_name] = time.time()
-            print(f"Loaded {model_name}.")
-            return self._models[model_name]
+                self._metrics["loads"] += 1
+                MODEL_LOADS.labels(model_name).inc()
+                MODEL_LOAD_SECONDS.labels(model_name).observe(elapsed)
+                MODEL_RESIDENT_BYTES.labels(model_name).set(self._sizes[model_name])
+                # The first load pays for downloads and snapshots; later ones are the reload latency
+                self._load_seconds.setdefault(model_name, []).append(elapsed)
+                self._evict_to_fit(0, keep=model_name)
+                print(f"Loaded {model_name} in {elapsed:.2f}s.")
+        self._last_access[model_name] = time.time()
+        self._pending_unload.discard(model_name)
+        return self._models[model_name]
+
+    async def load(self, model_name: str, model_class):
+        # Unleased handle; prefer lease() when the model is used across awaits
+        return await self._ensure_loaded(model_name, model_class)
+
+    @asynccontextmanager
+    async def lease(self, model_name: str, model_class):
+        model = await self._ensure_loaded(model_name, model_class)
+        self._leases[model_name] = self._leases.get(model_name, 0) + 1
+        try:
+            yield model
+        finally:
+            self._leases[model_name] -= 1
+            self._last_access[model_name] = time.time()
+            if self._leases[model_name] == 0:
+                del self._leases[model_name]
+                if model_name in self._pending_unload:
+                    self._pending_unload.discard(model_name)
+                    self._drop(model_name, reason="deferred")
+
+    def _evict_to_fit(self, incoming: int, keep: str):
+        # Least recently used first; never the model being loaded or one that is leased
+        if not self._memory_budget:
+            return
+        while self.resident + incoming > self._memory_budget:
+            candidates = [name for name in self._models if name != keep and name not in self._leases]
+            if not candidates:
+                logging.warning(
+                    f"{keep} needs {(self.resident + incoming) / 2**20:.0f} MB, "
+                    f"over the {self._memory_budget / 2**20:.0f} MB budget with nothing left to evict"
+                )
+                return
+            victim = min(candidates, key=lambda name: self._last_access.get(name, 0))
+            self._metrics["evictions"] += 1
+            self._metrics["evicted_bytes"] += self._sizes.get(victim, 0)
+            print(f"Evicting {victim} to make room for {keep}.")
+            self._drop(victim, reason="evicted")
+        gc.collect()
+
+    def _drop(self, model_name: str, reason: str = "unload"):
+        if model_name in self._models:
+            try:
+                del self._models[model_name]
+                self._last_access.pop(model_name, None)
+                self._sizes.pop(model_name, None)
+                MODEL_UNLOADS.labels(model_name, reason).inc()
+                MODEL_RESIDENT_BYTES.labels(model_name).set(0)
+                print(f"Unloaded {model_name}.")
+            except Exception as e:
+                logging.error(f"Error unloading model {model_name}: {e}")
+                raise
 
     async def unload(self, model_name: str):
-        async with self._lock:
-            if model_name in self._models:
-                try:
-                    del self._models[model_name]
-                    del self._last_access[model_name]
-                    print(f"Unloaded {model_name}.")
-                except Exception as e:
-                    logging.error(f"Error unloading model {model_name}: {e}")
-                    raise
+        # A leased model goes away when its last lease is released
+        if model_name in self._leases:
+            self._pending_unload.add(model_name)
+        else:
+            self._drop(model_name)
 
     async def clean(self):
-        async with self._lock:
-            for model_name in list(self._models.keys()):
-                await self.unload(model_name)
+        for model_name in list(self._models.keys()):
+            await self.unload(model_name)
+
+    def stats(self) -> dict:
+        return {
+            "memory_budget_bytes": self._memory_budget,
+            "resident_bytes": self.resident,
+            "models": {
+                name: {
+                    "resident_bytes": self._sizes.get(name, 0),
+                    "last_access": self._last_access.get(name),
+                    "leases": self._leases.get(name, 0),
+                }
+                for name in self._models
+            },
+            "load_seconds": {
+                name: {"first": seconds[0], "last": seconds[-1], "count": len(seconds)}
+                for name, seconds in self._load_seconds.items()
+            },
+            **self._metrics,
+        }
 
     async def _cleanup_idle_models(self):
         while True:
             await asyncio.sleep(self._idle_timeout)
             current_time = time.time()
-            async with self._lock:
-                for model_name in list(self._models.keys()):
-                    if current_time - self._last_access.get(model_name, 0) > self._idle_timeout:
-                        await self.unload(model_name)
+            for model_name in list(self._models.keys()):
+                if model_name in self._leases:
+                    continue
+                if current_time - self._last_access.get(model_name, 0) > self._idle_timeout:
+                    self._metrics["idle_unloads"] += 1
+                    self._drop(model_name, reason="idle")
 
-        
+
+CLIP_MAX_BATCH_SIZE = int(os.getenv("CLIP_MAX_BATCH_SIZE", "32"))
+CLIP_MODEL_ID = "openai/clip-vit-large-patch14"
+MODEL_CACHE_DIR = os.getenv("MODEL_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "model_cache"))
+
+
+def local_snapshot(model_id: str) -> str:
+    return os.path.join(MODEL_CACHE_DIR, model_id.replace("/", "--"))
+
+
+def save_snapshot(path: str, *components):
+    # Write to a temp dir and rename, so a crash never leaves a half-written snapshot behind
+    tmp = f"{path}.tmp-{os.getpid()}"
+    try:
+        for component in components:
+            if hasattr(component, "save_pretrained"):
+                if isinstance(component, nn.Module):
+                    component.save_pretrained(tmp, safe_serialization=True)
+                else:
+                    component.save_pretrained(tmp)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp, path)
+    except Exception as e:
+        logging.error(f"Error saving model snapshot to {path}: {e}")
+        shutil.rmtree(tmp, ignore_errors=True)
 
 
 class ClipEmbedder:
@@ -75,30 +234,151 @@ class ClipEmbedder:
     @classmethod
     async def loader(cls):
         try:
-            model = await asyncio.to_thread(CLIPModel.from_pretrained, "openai/clip-vit-large-patch14")
-            processor = await asyncio.to_thread(CLIPProcessor.from_pretrained, "openai/clip-vit-large-patch14")
-            tokenizer = await asyncio.to_thread(CLIPTokenizerFast.from_pretrained, "openai/clip-vit-large-patch14")
+            # Reload from the local safetensors snapshot when we have one: no hub round-trips,
+            # and the weights are memory-mapped instead of read and copied
+            snapshot = local_snapshot(CLIP_MODEL_ID)
+            source = snapshot if os.path.isdir(snapshot) else CLIP_MODEL_ID
+            local = source == snapshot
+
+            if os.getenv("INFERENCE_BACKEND", "torch") == "onnx":
+                from common.onnx_backend import OnnxDualEncoder
+                processor = await asyncio.to_thread(CLIPProcessor.from_pretrained, source, local_files_only=local)
+                load_model = partial(
+                    OnnxDualEncoder.from_pretrained,
+                    lambda: CLIPModel.from_pretrained(source, local_files_only=local),
+                    processor,
+                    export_dir=os.getenv("ONNX_EXPORT_DIR", "onnx/clip"),
+                    quantize=os.getenv("ONNX_QUANTIZE", "0") == "1",
+                    intra_op_threads=int(os.getenv("ORT_INTRA_OP_THREADS", "0")) or None,
+                )
+                model, tokenizer = await asyncio.gather(
+                    asyncio.to_thread(load_model),
+                    asyncio.to_thread(CLIPTokenizerFast.from_pretrained, source, local_files_only=local),
+                )
+            else:
+                # The three components are independent, so load them side by side
+                model, processor, tokenizer = await asyncio.gather(
+                    asyncio.to_thread(CLIPModel.from_pretrained, source, use_safetensors=True, local_files_only=local),
+                    asyncio.to_thread(CLIPProcessor.from_pretrained, source, local_files_only=local),
+                    asyncio.to_thread(CLIPTokenizerFast.from_pretrained, source, local_files_only=local),
+                )
+                model.eval()
+                if not local:
+                    await asyncio.to_thread(save_snapshot, snapshot, model, processor, tokenizer)
             return cls(model, processor, tokenizer)
         except Exception as e:
             logging.error(f"Error loading CLIP model: {e}")
             raise
 
-    async def text2vec(self, text: str) -> Optional[torch.Tensor]:
-        try:
+    def _text2vec(self, text: str) -> torch.Tensor:
+        with stage("clip_text", "preprocess"):
             inputs = self.tokenizer(text, return_tensors="pt", padding=True, truncation=True)
-            with torch.no_grad():
-                text_features = self.model.get_text_features(**inputs)
+        BATCH_SIZE.labels("clip_text").observe(len(inputs["input_ids"]))
+        with stage("clip_text", "forward"), torch.no_grad():
+            text_features = self.model.get_text_features(**inputs)
+        with stage("clip_text", "postprocess"):
             return text_features / text_features.norm(dim=-1, keepdim=True)
+
+    def _img2vec(self, image: Image.Image) -> torch.Tensor:
+        with stage("clip", "preprocess"):
+            inputs = self.processor(images=image, return_tensors="pt")
+        return self._pixels2vec(inputs["pixel_values"])
+
+    def _pixels2vec(self, pixel_values) -> torch.Tensor:
+        BATCH_SIZE.labels("clip").observe(len(pixel_values))
+        with stage("clip", "forward"), torch.no_grad():
+            image_features = self.model.get_image_features(pixel_values=torch.as_tensor(pixel_values))
+        with stage("clip", "postprocess"):
+            return image_features / image_features.norm(dim=-1, keepdim=True)
+
+    async def pixels2vec(self, batch: SharedBatch, as_numpy: bool = False):
+        # Embeds a batch preprocessed by PreprocessPool (spec "clip") without copying it
+        # out of shared memory. Same (embeddings, failed) contract as img2vec_batch.
+        embeddings = await executor.run(self._pixels2vec, batch.array)
+        if batch.failed:
+            embeddings = embeddings[batch.ok]
+        return self._collect([embeddings], as_numpy), list(batch.failed)
+
+    def _img2vec_chunk(self, images: list) -> tuple[Optional[torch.Tensor], list[int]]:
+        # Decode per item so one unreadable file only drops itself
+        decoded, failed = [], []
+        for i, image in enumerate(images):
+            try:
+                if isinstance(image, str):
+                    image = Image.open(image)
+                decoded.append(image.convert("RGB"))
+            except Exception as e:
+                logging.error(f"Error decoding image {i} for img2vec: {e}")
+                failed.append(i)
+        if not decoded:
+            return None, failed
+        return self._img2vec(decoded), failed
+
+    async def img2vec_batch(
+        self,
+        images: list,
+        batch_size: int = CLIP_MAX_BATCH_SIZE,
+        as_numpy: bool = False,
+        preprocess_pool: Optional[PreprocessPool] = None
+    ):
+        # Images may be PIL images or paths (or encoded bytes, with a pool). Returns
+        # (embeddings, failed): one normalized row per input that succeeded, in input
+        # order, plus the indices that failed. With a pool, paths and bytes are decoded
+        # across its worker processes instead of on the inference thread.
+        pooled = preprocess_pool is not None and all(isinstance(image, (str, bytes, bytearray)) for image in images)
+        chunks, failed = [], []
+        for start in range(0, len(images), batch_size):
+            chunk = images[start:start + batch_size]
+            try:
+                if pooled:
+                    with await preprocess_pool.preprocess(chunk, "clip") as batch:
+                        embeddings, chunk_failed = await self.pixels2vec(batch)
+                    embeddings = embeddings if len(embeddings) else None
+                else:
+                    embeddings, chunk_failed = await executor.run(self._img2vec_chunk, chunk)
+            except InferenceSaturated:
+                raise
+            except Exception as e:
+                logging.error(f"Error in img2vec_batch: {e}")
+                embeddings, chunk_failed = None, list(range(len(chunk)))
+            if embeddings is not None:
+                chunks.append(embeddings)
+            failed.extend(start + i for i in chunk_failed)
+        return self._collect(chunks, as_numpy), failed
+
+    async def text2vec_batch(self, texts: list[str], batch_size: int = CLIP_MAX_BATCH_SIZE, as_numpy: bool = False):
+        # Same contract as img2vec_batch; each chunk is padded to its longest text
+        chunks, failed = [], []
+        for start in range(0, len(texts), batch_size):
+            chunk = texts[start:start + batch_size]
+            try:
+                chunks.append(await executor.run(self._text2vec, chunk))
+            except InferenceSaturated:
+                raise
+            except Exception as e:
+                logging.error(f"Error in text2vec_batch: {e}")
+                failed.extend(range(start, start + len(chunk)))
+        return self._collect(chunks, as_numpy), failed
+
+    @staticmethod
+    def _collect(chunks: list, as_numpy: bool):
+        embeddings = torch.cat(chunks) if chunks else torch.empty((0, 0))
+        return embeddings.numpy() if as_numpy else embeddings
+
+    async def text2vec(self, text: str) -> Optional[torch.Tensor]:
+        try:
+            return await executor.run(self._text2vec, text)
+        except InferenceSaturated:
+            raise
         except Exception as e:
             logging.error(f"Error in text2vec: {e}")
             return None
 
     async def img2vec(self, image: Image.Image) -> Optional[torch.Tensor]:
         try:
-            inputs = self.processor(images=image, return_tensors="pt")
-            with torch.no_grad():
-                image_features = self.model.get_image_features(**inputs)
-            return image_features / image_features.norm(dim=-1, keepdim=True)
+            return await executor.run(self._img2vec, image)
+        except InferenceSaturated:
+            raise
         except Exception as e:
             logging.error(f"Error in img2vec: {e}")
             return None
@@ -125,10 +405,10 @@ class MLP(pl.LightningModule):
 class AestheticScorer:
     def __init__(self):
         self.device = 'cpu'
-        self.model_path = '/home/praveen/cloudforge/inference/state.pth'    
+        self.model_path = os.getenv("AESTHETIC_MODEL_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "state.pth"))
         self.model = MLP()
         try:
-            state = torch.load(self.model_path, map_location=self.device)
+            state = self._load_state(self.model_path, self.device)
             self.model.load_state_dict(state)
             self.model.to(self.device)
             self.model.eval()
@@ -136,23 +416,68 @@ class AestheticScorer:
             logging.error(f"Error loading MLP model: {e}")
             raise
 
+    @staticmethod
+    def _load_state(path: str, device: str) -> dict:
+        # Convert state.pth to safetensors once; after that reloads are a memory map
+        # instead of an unpickle
+        safetensors_path = os.path.splitext(path)[0] + ".safetensors"
+        if not os.path.exists(safetensors_path):
+            state = torch.load(path, map_location=device)
+            # Temp file and rename, as in save_snapshot: a crash or a second worker
+            # converting at the same time must never leave a truncated file behind
+            tmp = f"{safetensors_path}.tmp-{os.getpid()}"
+            try:
+                save_file({k: v.contiguous() for k, v in state.items()}, tmp)
+                os.replace(tmp, safetensors_path)
+            except Exception as e:
+                logging.error(f"Error writing {safetensors_path}: {e}")
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+            return state
+        return load_file(safetensors_path, device=device)
+
     @classmethod
     async def loader(cls):
         try:
-            instance = cls()
+            instance = await asyncio.to_thread(cls)
             return instance
         except Exception as e:
             logging.error(f"Error in AestheticScorer.loader: {e}")
             raise
 
+    def _score(self, embedding: torch.Tensor) -> torch.Tensor:
+        BATCH_SIZE.labels("aesthetic").observe(len(embedding) if embedding.dim() > 1 else 1)
+        with stage("aesthetic", "forward"), torch.no_grad():
+            return self.model(embedding)
+
+    def score_embeddings(self, embeddings, batch_size: int = 65536) -> np.ndarray:
+        # Scores precomputed CLIP ViT-L/14 image embeddings without touching CLIP.
+        # The MLP was trained on L2-normalized vectors, so normalize whatever we're given.
+        embeddings = torch.as_tensor(np.asarray(embeddings, dtype=np.float32))
+        embeddings = embeddings / embeddings.norm(dim=-1, keepdim=True).clamp_min(1e-12)
+        scores = [
+            self._score(embeddings[start:start + batch_size].to(self.device)).cpu()
+            for start in range(0, len(embeddings), batch_size)
+        ]
+        return torch.cat(scores).numpy().reshape(-1) if scores else np.empty(0, dtype=np.float32)
+
+    async def predict_batch(self, imgs: list, model_manager: ModelManager, batch_size: int = CLIP_MAX_BATCH_SIZE):
+        # Returns (scores, failed) with one score per image that embedded successfully
+        async with model_manager.lease("clip", ClipEmbedder) as clip_embedder:
+            embeddings, failed = await clip_embedder.img2vec_batch(imgs, batch_size)
+        if len(embeddings) == 0:
+            return np.empty(0, dtype=np.float32), failed
+        predictions = await executor.run(self._score, embeddings.to(self.device))
+        return predictions.cpu().numpy().reshape(-1), failed
+
     async def predict(self, img, model_manager: ModelManager):
         try:
-            # Load ClipEmbedder via ModelManager
-            clip_embedder: ClipEmbedder = await model_manager.load("clip", ClipEmbedder)
-
             if isinstance(img, str):
                 img = Image.open(img).convert("RGB")
-            image_embedding = await clip_embedder.img2vec(img)
+
+            # Lease ClipEmbedder via ModelManager so it can't be reaped mid-forward
+            async with model_manager.lease("clip", ClipEmbedder) as clip_embedder:
+                image_embedding = await clip_embedder.img2vec(img)
             if image_embedding is None:
                 logging.error("Failed to generate image embedding.")
                 return None
@@ -163,18 +488,22 @@ class AestheticScorer:
             else:
                 embedding = torch.tensor(image_embedding).to(self.device)
 
-            with torch.no_grad():
-                prediction = self.model(embedding)
+            prediction = await executor.run(self._score, embedding)
 
             if self.device == "cuda":
                 prediction = prediction.cpu()
 
             return prediction.item()
+        except InferenceSaturated:
+            raise
         except Exception as e:
             logging.error(f"Error in AestheticScorer.predict: {e}")
             return None
         
 
+TAGGER_MAX_BATCH_SIZE = int(os.getenv("TAGGER_MAX_BATCH_SIZE", "32"))
+
+
 # onnx only
 class ImageTagger:
     def __init__(self, model, top_tags: list[str]):
@@ -182,6 +511,8 @@ class ImageTagger:
         self.model = model
         self.top_tags = top_tags
         self.threshold = 0.4
+        # ORT keeps roughly the weight file in memory
+        self.resident_bytes = model.get('resident_bytes', 0)
 
     @classmethod
     async def loader(cls) -> "ImageTagger":
@@ -203,44 +534,106 @@ class ImageTagger:
         providers = ['TensorrtExecutionProvider', 'CUDAExecutionProvider', 'CPUExecutionProvider']
         session = ort.InferenceSession(str(onnx_path), providers=providers)
         input_name = session.get_inputs()[0].name
-        return {'session': session, 'input_name': input_name, 'image_size': 448}
+        return {'session': session, 'input_name': input_name, 'image_size': 448, 'resident_bytes': os.path.getsize(onnx_path)}
 
     @staticmethod
-    def _preprocess(image: Image.Image, target_size: int) -> torch.Tensor:
-        image_shape = image.size
-        max_dim = max(image_shape)
-        pad_left = (max_dim - image_shape[0]) // 2
-        pad_top = (max_dim - image_shape[1]) // 2
-
-        padded_image = Image.new("RGB", (max_dim, max_dim), (255, 255, 255))
-        padded_image.paste(image, (pad_left, pad_top))
-
-        # Resize image
-        if max_dim != target_size:
-            padded_image = padded_image.resize((target_size, target_size), Image.BICUBIC)
-
-        # Convert to tensor
-        image_tensor = TVF.pil_to_tensor(padded_image) / 255.0
-
-        # Normalize
-        image_tensor = TVF.normalize(
-            image_tensor,
-            mean=[0.48145466, 0.4578275, 0.40821073],
-            std=[0.26862954, 0.26130258, 0.27577711],
-        )
-        return image_tensor
-
-    @torch.no_grad()
-    async def predict(self, image: Image.Image, limit:int=20) -> tuple[str, dict, float]:
+    def _letterbox_batch(images: list, target_size: int) -> np.ndarray:
+        # Letterbox each image straight into one preallocated uint8 batch, then
+        # normalize the whole batch in one pass (JoyTag uses the CLIP mean/std)
+        batch = np.empty((len(images), target_size, target_size, 3), dtype=np.uint8)
+        for i, image in enumerate(images):
+            letterbox(image, target_size, out=batch[i])
+        return normalize(batch)
+
+    def _select(self, probs: np.ndarray, limit: int, threshold: float) -> list[dict]:
+        # Top-k over the full vocabulary with a partial sort, then order and threshold just those k
+        k = min(limit, probs.shape[1])
+        if k <= 0:
+            return [{} for _ in probs]
+        top = np.argpartition(-probs, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(probs, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        top, top_scores = np.take_along_axis(top, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+        return [
+            {self.top_tags[i]: float(score) for i, score in zip(indices, scores) if score >= threshold}
+            for indices, scores in zip(top, top_scores)
+        ]
+
+    def _predict_batch(self, images: list, limit: int, threshold: float) -> tuple[list[dict], list[int]]:
+        decoded, failed = [], []
+        for i, image in enumerate(images):
+            try:
+                image = Image.open(image) if isinstance(image, str) else image
+                image.load()
+                decoded.append((i, image))
+            except Exception as e:
+                logging.error(f"Error decoding image {i} for tagging: {e}")
+                failed.append(i)
+
+        results = [{} for _ in images]
+        if decoded:
+            with stage("tagger", "preprocess"):
+                batch = self._letterbox_batch([image for _, image in decoded], self.image_size)
+            for (i, _), tags in zip(decoded, self._tag_pixels(batch, limit, threshold)):
+                results[i] = tags
+        return results, failed
+
+    def _tag_pixels(self, batch: np.ndarray, limit: int, threshold: float) -> list[dict]:
+        BATCH_SIZE.labels("tagger").observe(len(batch))
+        with stage("tagger", "forward"):
+            logits = self.model['session'].run(None, {self.model['input_name']: batch})[0]
+        with stage("tagger", "postprocess"):
+            # Numerically stable sigmoid
+            probs = 0.5 * (1 + np.tanh(0.5 * logits))
+            return self._select(probs, limit, threshold)
+
+    async def predict_pixels(self, batch: SharedBatch, limit: int = 20, threshold: Optional[float] = None) -> list[dict]:
+        # Tags a batch preprocessed by PreprocessPool (spec "tagger"); ORT reads the
+        # shared buffer directly. Failed rows come back as {}.
+        threshold = self.threshold if threshold is None else threshold
+        results = await executor.run(self._tag_pixels, batch.array, limit, threshold)
+        for i in batch.failed:
+            results[i] = {}
+        return results
+
+    async def predict_batch(
+        self,
+        images: list,
+        limit: int = 20,
+        threshold: Optional[float] = None,
+        batch_size: int = TAGGER_MAX_BATCH_SIZE,
+        preprocess_pool: Optional[PreprocessPool] = None
+    ) -> tuple[list[dict], list[int]]:
+        # Images may be PIL images or paths (or encoded bytes, with a pool). Returns one
+        # {tag: score} dict per input (empty for failures) plus the indices that failed.
+        threshold = self.threshold if threshold is None else threshold
+        pooled = preprocess_pool is not None and all(isinstance(image, (str, bytes, bytearray)) for image in images)
+        results, failed = [], []
+        for start in range(0, len(images), batch_size):
+            chunk = images[start:start + batch_size]
+            try:
+                if pooled:
+                    with await preprocess_pool.preprocess(chunk, "tagger") as batch:
+                        chunk_results = await self.predict_pixels(batch, limit, threshold)
+                        chunk_failed = list(batch.failed)
+                else:
+                    chunk_results, chunk_failed = await executor.run(self._predict_batch, chunk, limit, threshold)
+            except InferenceSaturated:
+                raise
+            except Exception as e:
+                logging.error(f"Error during batch prediction: {e}")
+                chunk_results, chunk_failed = [{} for _ in chunk], list(range(len(chunk)))
+            results.extend(chunk_results)
+            failed.extend(start + i for i in chunk_failed)
+        return results, failed
+
+    async def predict(self, image: Image.Image, limit: int = 20, threshold: Optional[float] = None) -> dict:
         try:
-            image_tensor = self._preprocess(image, self.image_size)
-            batch = image_tensor.unsqueeze(0)
-            inputs = {self.model['input_name']: batch.numpy()}
-            preds = self.model['session'].run(None, inputs)
-            tag_preds = torch.from_numpy(preds[0]).sigmoid()
-            scores = {self.top_tags[i]: tag_preds[0][i].item() for i in range(min(limit, len(self.top_tags)))}
-            return scores
+            results, failed = await self.predict_batch([image], limit, threshold)
+            return results[0]
 
+        except InferenceSaturated:
+            raise
         except Exception as e:
             logging.error(f"Error during prediction: {e}")
             return {}
@@ -248,11 +641,13 @@ class ImageTagger:
 async def main():
     logging.basicConfig(level=logging.ERROR)
     manager = ModelManager()
-    
+    if os.getenv("METRICS_PORT"):
+        serve(int(os.getenv("METRICS_PORT")))
+
     try:
         path = '/home/praveen/cloudforge/frontend/public/assets/empty.jpg'
-        aesthetic_scorer: AestheticScorer = await manager.load('aesthetic', AestheticScorer)
-        prediction = await aesthetic_scorer.predict(path, manager)
+        async with manager.lease('aesthetic', AestheticScorer) as aesthetic_scorer:
+            prediction = await aesthetic_scorer.predict(path, manager)
         print(f"Aesthetic Score: {prediction}")
     except Exception as e:
         logging.error(f"An error occurred in main: {e}")
@@ -1,15 +1,20 @@
-from pymilvus import connections, Collection, DataType, CollectionSchema, FieldSchema
+from pymilvus import Collection, DataType, CollectionSchema, FieldSchema
 import logging
 import numpy as np
-from typing import Optional, Dict
+import json
+from typing import Iterator, Optional, Dict, Union
 from deepface import DeepFace
+from deepface.modules import preprocessing
+
+from common.milvus_pool import MilvusPool, get_pool
 
 
 def create_embedding_collection():
     fields = [
         FieldSchema(name="id", dtype=DataType.VARCHAR, max_length=255, is_primary=True),
         FieldSchema(name="image_embedding", dtype=DataType.FLOAT_VECTOR, dim=768),
-        FieldSchema(name="text_embedding", dtype=DataType.FLOAT_VECTOR, dim=768)
+        FieldSchema(name="text_embedding", dtype=DataType.FLOAT_VECTOR, dim=768),
+        FieldSchema(name="aesthetic_score", dtype=DataType.FLOAT)
     ]
     schema = CollectionSchema(fields=fields)
     collection = Collection("Embeddings", schema)
@@ -20,9 +25,12 @@ def create_embedding_collection():
     return collection
 
 def create_face_collection():
+    # Enrolled identities and discovered cluster centroids (face_clustering.py);
+    # member_count drives the clusters' running means
     fields = [
         FieldSchema(name="id", dtype=DataType.VARCHAR, max_length=255, is_primary=True),
-        FieldSchema(name="face_embed", dtype=DataType.FLOAT_VECTOR, dim=512)
+        FieldSchema(name="face_embed", dtype=DataType.FLOAT_VECTOR, dim=512),
+        FieldSchema(name="member_count", dtype=DataType.INT64)
     ]
     schema = CollectionSchema(fields=fields)
     collection = Collection("FaceRecognition", schema)
@@ -31,10 +39,37 @@ def create_face_collection():
     collection.create_index("face_embed", index_params)
     return collection
 
-def initialize():
-    connections.connect("default", uri="http://localhost:19530")
+def create_faces_collection():
+    # One row per detected face, keyed "<image_id>#<n>", with the cluster it joined
+    fields = [
+        FieldSchema(name="id", dtype=DataType.VARCHAR, max_length=600, is_primary=True),
+        FieldSchema(name="image_id", dtype=DataType.VARCHAR, max_length=512),
+        FieldSchema(name="cluster_id", dtype=DataType.VARCHAR, max_length=255),
+        FieldSchema(name="face_embed", dtype=DataType.FLOAT_VECTOR, dim=512)
+    ]
+    schema = CollectionSchema(fields=fields)
+    collection = Collection("Faces", schema)
+
+    index_params = {"index_type": "IVF_FLAT", "metric_type": "IP", "params": {"nlist": 1024}}
+    collection.create_index("face_embed", index_params)
+    # Merges and splits look faces up by cluster
+    collection.create_index("cluster_id", {"index_type": "INVERTED"})
+    collection.create_index("image_id", {"index_type": "INVERTED"})
+    return collection
+
+# Milvus rejects searches where offset + limit exceeds this
+MAX_SEARCH_WINDOW = 16384
+# IVF lists probed by range searches over Faces (nlist is 1024). A face in an unprobed
+# list is silently missing from "every photo of this person", so err on the high side.
+RANGE_NPROBE = 128
+# Discovered clusters (face_clustering.py) share FaceRecognition with enrolled identities
+CLUSTER_PREFIX = "cluster-"
+
+def initialize(uri: Optional[str] = None):
+    get_pool(uri).connection()
     create_embedding_collection()
     create_face_collection()
+    create_faces_collection()
 
 
 
@@ -42,7 +77,7 @@ def initialize():
 class FaceRecognizer:
     def __init__(
         self,
-        uri: str = "http://localhost:19530",
+        uri: Optional[str] = None,
         model_name: str = "Facenet512",
         detector_backend: str = "retinaface",
         similarity_threshold: float = 0.9
@@ -51,14 +86,13 @@ class FaceRecognizer:
         self.detector_backend = detector_backend
         self.embedding_dim = 512
         self.similarity_threshold = similarity_threshold
-        self._initialize_connection(uri)
+        self._model = None
+        # Borrowed from the process-wide pool; recognizers never connect or disconnect
+        self.pool: MilvusPool = get_pool(uri)
+        self.collection = self.pool.collection("FaceRecognition")
 
-    def _initialize_connection(self, uri: str) -> None:
-        connections.connect("default", uri=uri)
-        self.collection = Collection("FaceRecognition")
-        self.collection.load()
-
-    def _get_embedding(self, image: str) -> list[float]:
+    def _get_embedding(self, image: Union[str, np.ndarray]) -> list[float]:
+        # image is a path or an already-decoded BGR array
         result = DeepFace.represent(
             img_path=image,
             model_name=self.model_name,
@@ -70,12 +104,137 @@ class FaceRecognizer:
             embedding = embedding / norm
         return embedding.tolist()
 
+    @property
+    def model(self):
+        # DeepFace caches built models globally; keep our own handle for batched forwards
+        if self._model is None:
+            self._model = DeepFace.build_model(self.model_name)
+        return self._model
+
+    def detect_faces(self, image: Union[str, np.ndarray], min_confidence: float = 0.9) -> list[dict]:
+        # Every face in the image, aligned and cropped, with its box in image coordinates
+        faces = DeepFace.extract_faces(
+            img_path=image,
+            detector_backend=self.detector_backend,
+            align=True,
+            enforce_detection=False
+        )
+        # Without enforce_detection a faceless image comes back as one whole-image "face" at confidence 0
+        return [
+            {
+                "face": face["face"],
+                "bbox": {key: int(face["facial_area"][key]) for key in ("x", "y", "w", "h")},
+                "confidence": float(face.get("confidence") or 0),
+            }
+            for face in faces
+            if (face.get("confidence") or 0) >= min_confidence
+        ]
+
+    def _prepare(self, face: np.ndarray) -> np.ndarray:
+        # Same steps DeepFace.represent takes between detection and the forward:
+        # extract_faces hands back RGB, the model wants BGR at its input size
+        target_height, target_width = self.model.input_shape
+        face = preprocessing.resize_image(face[:, :, ::-1], target_size=(target_width, target_height))
+        return preprocessing.normalize_input(face, normalization="base")
+
+    def embed_faces(self, faces: list[np.ndarray], batch_size: int = 64) -> np.ndarray:
+        # One forward per batch_size aligned crops instead of one per face; rows are L2-normalized
+        if not faces:
+            return np.empty((0, self.embedding_dim), dtype=np.float32)
+        chunks = []
+        for start in range(0, len(faces), batch_size):
+            batch = np.concatenate([self._prepare(face) for face in faces[start:start + batch_size]])
+            chunks.append(np.asarray(self.model.model(batch, training=False), dtype=np.float32))
+        embeddings = np.concatenate(chunks)
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return embeddings / np.maximum(norms, 1e-12)
+
+    def represent_batch(
+        self,
+        images: list,
+        batch_size: int = 64,
+        min_confidence: float = 0.9
+    ) -> tuple[list[list[dict]], list[int]]:
+        # Images are paths or BGR arrays. Returns one list of faces per input (each
+        # with bbox, confidence and a normalized 512-d embedding) plus the indices
+        # that failed. Detection runs per image; embedding is batched across all faces.
+        results, failed, crops, owners = [[] for _ in images], [], [], []
+        detected = []
+        for i, image in enumerate(images):
+            try:
+                faces = self.detect_faces(image, min_confidence)
+            except Exception as e:
+                logging.error(f"Face detection failed for image {i}: {str(e)}")
+                failed.append(i)
+                continue
+            for face in faces:
+                crops.append(face.pop("face"))
+                owners.append(i)
+                detected.append(face)
+                results[i].append(face)
+
+        try:
+            embeddings = self.embed_faces(crops, batch_size)
+        except Exception as e:
+            logging.error(f"Face embedding failed: {str(e)}")
+            failed = sorted(set(failed) | set(owners))
+            return [[] if i in failed else faces for i, faces in enumerate(results)], failed
+
+        for face, embedding in zip(detected, embeddings):
+            face["embedding"] = embedding
+        return results, failed
+
+    def identity_templates(
+        self,
+        photos: dict[str, list],
+        batch_size: int = 64
+    ) -> tuple[dict[str, np.ndarray], list[str], list[str]]:
+        # photos maps identity -> its images. Each photo contributes its largest face
+        # (the subject, not the bystanders); an identity's template is the renormalized
+        # mean of those. Returns the templates, the identities whose photos were all
+        # processed and had no usable face, and the identities left without a template
+        # because some photo failed to process (worth retrying, unlike the former).
+        flat = [(identity, image) for identity, images in photos.items() for image in images]
+        results, failed = self.represent_batch([image for _, image in flat], batch_size)
+        errored = {flat[i][0] for i in failed}
+        embeddings = {}
+        for (identity, _), faces in zip(flat, results):
+            if faces:
+                subject = max(faces, key=lambda face: face["bbox"]["w"] * face["bbox"]["h"])
+                embeddings.setdefault(identity, []).append(subject["embedding"])
+        templates = {}
+        for identity, rows in embeddings.items():
+            mean = np.mean(rows, axis=0)
+            templates[identity] = (mean / max(np.linalg.norm(mean), 1e-12)).astype(np.float32)
+        untemplated = [identity for identity in photos if identity not in templates]
+        return (
+            templates,
+            [identity for identity in untemplated if identity not in errored],
+            [identity for identity in untemplated if identity in errored]
+        )
+
+    def add_faces(self, templates: dict[str, np.ndarray], chunk_size: int = 512, flush: bool = True) -> int:
+        # Upsert so re-enrolling an identity replaces its template instead of duplicating
+        # the primary key; one flush at the end (or none, for callers batching further)
+        identities = list(templates)
+        for start in range(0, len(identities), chunk_size):
+            chunk = identities[start:start + chunk_size]
+            self.collection.upsert([
+                chunk,
+                [np.asarray(templates[identity]).tolist() for identity in chunk],
+                [1] * len(chunk)
+            ])
+        if flush and identities:
+            self.collection.flush()
+        return len(identities)
+
     def add_face(self, image: str, identity: str) -> bool:
         try:
             embedding = self._get_embedding(image)
             data = {
                 "id": [identity],
-                "face_embed": [embedding]
+                "face_embed": [embedding],
+                "member_count": [1]
             }
             self.collection.insert(data)
             self.collection.flush()
@@ -84,15 +243,23 @@ class FaceRecognizer:
             logging.error(f"Face addition failed - {identity}: {str(e)}")
             return False
 
-    def predict(self, image: str) -> Optional[str]:
+    def predict(self, image: Union[str, np.ndarray]) -> Optional[str]:
+        try:
+            return self.match(self._get_embedding(image))
+        except Exception as e:
+            logging.error(f"Prediction failed: {str(e)}")
+            return None
+
+    def match(self, embedding: list[float]) -> Optional[str]:
+        # Enrolled identities only: an unmerged cluster centroid is not a name, so
+        # cluster ids are filtered out rather than allowed to outscore a person
         try:
-            embedding = self._get_embedding(image)
-            
             results = self.collection.search(
                 data=[embedding],
                 anns_field="face_embed",
                 param={"metric_type": "IP", "params": {"nprobe": 10}},
-                limit=1
+                limit=1,
+                expr=f'not (id like "{CLUSTER_PREFIX}%")'
             )
 
             if not results[0]:
@@ -105,11 +272,106 @@ class FaceRecognizer:
             return match.id
 
         except Exception as e:
-            logging.error(f"Prediction failed: {str(e)}")
+            logging.error(f"Match failed: {str(e)}")
             return None
 
-    def __del__(self):
+    @property
+    def faces(self) -> Collection:
+        # Every detected face (face_clustering.py writes it); borrowed on first use
+        return self.pool.collection("Faces")
+
+    def _query_embedding(self, face=None, identity: Optional[str] = None) -> list[float]:
+        # face is an embedding, an image path or a BGR array; identity is an enrolled
+        # name or a discovered cluster id, whose template is the query
+        if identity is not None:
+            rows = self.collection.query(expr=f"id == {json.dumps(identity)}", output_fields=["face_embed"])
+            if not rows:
+                raise KeyError(f"Unknown identity {identity}")
+            return list(rows[0]["face_embed"])
+        if isinstance(face, str) or (isinstance(face, np.ndarray) and face.ndim == 3):
+            results, failed = self.represent_batch([face])
+            if failed or not results[0]:
+                raise ValueError("No face found in the query image")
+            # The most prominent face in the photo is the one being asked about
+            subject = max(results[0], key=lambda found: found["bbox"]["w"] * found["bbox"]["h"])
+            return subject["embedding"].tolist()
+        embedding = np.asarray(face, dtype=np.float32).reshape(-1)
+        return (embedding / max(np.linalg.norm(embedding), 1e-12)).tolist()
+
+    def _range_params(self, threshold: Optional[float], nprobe: int) -> dict:
+        # IP range search keeps score > radius. No range_filter upper bound: an exact
+        # match between float32 unit vectors can score a hair over 1.0 and would be dropped
+        threshold = self.similarity_threshold if threshold is None else threshold
+        return {"metric_type": "IP", "params": {"nprobe": max(1, nprobe), "radius": threshold}}
+
+    def find_faces(
+        self,
+        face=None,
+        identity: Optional[str] = None,
+        threshold: Optional[float] = None,
+        offset: int = 0,
+        limit: int = 100,
+        nprobe: int = RANGE_NPROBE
+    ) -> list[dict]:
+        """One page of every face above threshold, best match first.
+
+        Pass a face (embedding, path or BGR array) or an identity. Pages
+        are offset/limit within Milvus' 16384 search window; use
+        iter_images to walk past it. Raise nprobe (up to 1024, exhaustive)
+        for recall, lower it for speed.
+        """
+        offset = min(max(0, offset), MAX_SEARCH_WINDOW - 1)
+        limit = min(max(1, limit), MAX_SEARCH_WINDOW - offset)
+        results = self.faces.search(
+            data=[self._query_embedding(face, identity)],
+            anns_field="face_embed",
+            param=self._range_params(threshold, nprobe),
+            limit=limit,
+            offset=offset,
+            output_fields=["image_id", "cluster_id"]
+        )
+        return [
+            {"id": hit.id, "image_id": hit.entity.get("image_id"), "cluster_id": hit.entity.get("cluster_id"), "score": float(hit.score)}
+            for hit in results[0]
+        ]
+
+    def iter_images(
+        self,
+        face=None,
+        identity: Optional[str] = None,
+        threshold: Optional[float] = None,
+        page_size: int = 100,
+        nprobe: int = RANGE_NPROBE
+    ) -> Iterator[list[str]]:
+        """Yields pages of the distinct image ids containing a matching face.
+
+        Streams the range search with a search iterator, so it is one
+        query for the whole result instead of a top-1 call per face and
+        has no 16384 cap. Images come in order of their best face score.
+        """
+        iterator = self.faces.search_iterator(
+            data=[self._query_embedding(face, identity)],
+            anns_field="face_embed",
+            param=self._range_params(threshold, nprobe),
+            batch_size=max(page_size, 1000),
+            output_fields=["image_id"]
+        )
+        seen, page = set(), []
         try:
-            connections.disconnect("default")
-        except:
-            pass
\ No newline at end of file
+            while True:
+                hits = iterator.next()
+                if not hits:
+                    break
+                for hit in hits:
+                    image_id = hit.entity.get("image_id")
+                    if image_id in seen:
+                        continue
+                    seen.add(image_id)
+                    page.append(image_id)
+                    if len(page) == page_size:
+                        yield page
+                        page = []
+        finally:
+            iterator.close()
+        if page:
+            yield page
@@ -0,0 +1,166 @@
+import asyncio
+import io
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+from typing import Optional, Union
+
+import numpy as np
+from PIL import Image, ImageOps
+
+from common.metrics import stage
+
+# Kept free of torch/transformers so spawned workers start fast and stay small.
+
+CLIP_MEAN = np.array([0.48145466, 0.4578275, 0.40821073], dtype=np.float32)
+CLIP_STD = np.array([0.26862954, 0.26130258, 0.27577711], dtype=np.float32)
+
+
+def letterbox(image: Image.Image, size: int, out: Optional[np.ndarray] = None) -> np.ndarray:
+    # Pad to a centered white square, then resize to `size` (the JoyTag tagger's input).
+    # Padding before resizing, as the reference pipeline does, keeps the pixels along
+    # the image/padding border identical to what the model was trained on.
+    image = image.convert("RGB")
+    width, height = image.size
+    side = max(width, height)
+    if width != height:
+        square = Image.new("RGB", (side, side), (255, 255, 255))
+        square.paste(image, ((side - width) // 2, (side - height) // 2))
+        image = square
+    if side != size:
+        image = image.resize((size, size), Image.BICUBIC)
+    pixels = np.asarray(image)
+    if out is None:
+        return pixels.copy()
+    out[...] = pixels
+    return out
+
+
+def center_crop(image: Image.Image, size: int, out: Optional[np.ndarray] = None) -> np.ndarray:
+    # Short side to `size`, then a centered size x size crop (what CLIPProcessor does)
+    image = image.convert("RGB")
+    width, height = image.size
+    scale = size / min(width, height)
+    new_width, new_height = max(size, round(width * scale)), max(size, round(height * scale))
+    image = image.resize((new_width, new_height), Image.BICUBIC)
+    left, top = (new_width - size) // 2, (new_height - size) // 2
+    pixels = np.asarray(image.crop((left, top, left + size, top + size)))
+    if out is None:
+        return pixels.copy()
+    out[...] = pixels
+    return out
+
+
+def normalize(batch: np.ndarray, mean: np.ndarray = CLIP_MEAN, std: np.ndarray = CLIP_STD) -> np.ndarray:
+    # uint8 NHWC -> normalized float32 NCHW in one pass: (x / 255 - mean) / std
+    pixels = batch.astype(np.float32) * (1 / (255 * std)) - mean / std
+    return np.ascontiguousarray(pixels.transpose(0, 3, 1, 2))
+
+
+SPECS = {
+    "clip": (center_crop, 224),
+    "tagger": (letterbox, 448),
+}
+
+
+def _attach(name: str) -> SharedMemory:
+    try:
+        return SharedMemory(name=name, track=False)
+    except TypeError:
+        # Before 3.13 attaching registers the block again, but spawned workers share
+        # the parent's resource tracker, so that is a no-op; unregistering here would
+        # drop the parent's entry and its unlink would then trip the tracker
+        return SharedMemory(name=name)
+
+
+def _fill_slot(name: str, shape: tuple, index: int, source: Union[bytes, str], spec: str):
+    # Runs in a worker: decode, preprocess and write straight into the shared batch
+    transform, size = SPECS[spec]
+    image = Image.open(io.BytesIO(source) if isinstance(source, (bytes, bytearray)) else source)
+    image.draft("RGB", (size, size))
+    # Same orientation as analyze.decode, so pooled and in-process paths agree
+    pixels = transform(ImageOps.exif_transpose(image), size)
+    shm = _attach(name)
+    try:
+        batch = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+        batch[index] = normalize(pixels[None])[0]
+        del batch
+    finally:
+        shm.close()
+
+
+class SharedBatch:
+    """A preprocessed (N, 3, H, W) float32 batch living in shared memory.
+
+    `array` is a view on the block, so torch.from_numpy(batch.array)
+    hands it to the model without a copy. Rows listed in `failed` are
+    zeros. Close the batch (or use it as a context manager) once the
+    forward pass is done.
+    """
+
+    def __init__(self, shm: SharedMemory, shape: tuple):
+        self._shm = shm
+        self.shape = shape
+        self.array: Optional[np.ndarray] = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+        self.failed: list[int] = []
+
+    @property
+    def ok(self) -> list[int]:
+        failed = set(self.failed)
+        return [i for i in range(self.shape[0]) if i not in failed]
+
+    def close(self):
+        if self._shm is not None:
+            # The view has to go before the block can be closed
+            self.array = None
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class PreprocessPool:
+    """Process pool that decodes and preprocesses images into shared memory,
+    keeping JPEG decode and resize off the GIL of the inference process."""
+
+    def __init__(self, workers: Optional[int] = None):
+        self.workers = workers or int(os.getenv("PREPROCESS_WORKERS", "0")) or os.cpu_count() or 1
+        # spawn, not fork: forking a process that already runs torch threads can deadlock
+        self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+
+    async def preprocess(self, sources: list, spec: str) -> SharedBatch:
+        # sources are paths or encoded bytes; paths avoid shipping the file through a pipe
+        _, size = SPECS[spec]
+        shape = (len(sources), 3, size, size)
+        shm = SharedMemory(create=True, size=max(1, int(np.prod(shape)) * 4))
+        batch = SharedBatch(shm, shape)
+        try:
+            batch.array.fill(0)
+
+            loop = asyncio.get_running_loop()
+            with stage(spec, "preprocess"):
+                results = await asyncio.gather(
+                    *(loop.run_in_executor(self._pool, _fill_slot, shm.name, shape, i, source, spec)
+                      for i, source in enumerate(sources)),
+                    return_exceptions=True
+                )
+        except BaseException:
+            # Cancelled (a batcher closing at shutdown) or failed: nobody else will
+            # close the batch, and the block would outlive us in /dev/shm
+            batch.close()
+            raise
+        for i, result in enumerate(results):
+            if isinstance(result, Exception):
+                logging.error(f"Error preprocessing image {i} for {spec}: {result}")
+                batch.failed.append(i)
+        return batch
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,205 @@
+"""Local inference service for the CLIP, tagger and aesthetic models.
+
+Keeps ModelManager and the model weights in one process so API workers
+can scale out without each holding them. Concurrent requests are
+batched server-side. Run it over a Unix socket or TCP:
+
+    python server.py --uds /run/inference.sock
+    python server.py --host 127.0.0.1 --port 8001
+
+Images are sent as their encoded bytes and text as UTF-8 in the request
+body. Embeddings come back as raw little-endian float32 (the dimension
+is in X-Embedding-Dim); send Accept: application/json to get a list.
+client.py wraps all of this.
+"""
+import argparse
+import logging
+import os
+from contextlib import asynccontextmanager
+from typing import Optional
+
+import numpy as np
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import JSONResponse, Response
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+
+from common.batching import MicroBatcher
+from common.errors import InferenceSaturated
+from common.metrics import QUEUE_DEPTH
+from main import AestheticScorer, ClipEmbedder, ImageTagger, ModelManager, executor
+from preprocess_pool import PreprocessPool
+
+FLOAT32 = "application/octet-stream"
+SERVE_MAX_BATCH_SIZE = int(os.getenv("SERVE_MAX_BATCH_SIZE", "32"))
+SERVE_MAX_WAIT_MS = float(os.getenv("SERVE_MAX_WAIT_MS", "5"))
+SERVE_MAX_QUEUE = int(os.getenv("SERVE_MAX_QUEUE", "512"))
+
+model_manager: Optional[ModelManager] = None
+# Decodes and preprocesses request images across processes; set up in lifespan
+preprocess_pool: Optional[PreprocessPool] = None
+
+
+def _scatter(rows, failed: list[int], count: int, message: str) -> list:
+    # Turns a batched (rows, failed) result back into one output per input
+    failed, rows = set(failed), iter(rows)
+    return [ValueError(message) if i in failed else next(rows) for i in range(count)]
+
+
+async def _embed_images(images: list) -> list:
+    async with model_manager.lease("clip", ClipEmbedder) as clip_embedder:
+        embeddings, failed = await clip_embedder.img2vec_batch(images, as_numpy=True, preprocess_pool=preprocess_pool)
+    return _scatter(embeddings, failed, len(images), "CLIP embedding failed")
+
+
+async def _embed_texts(texts: list) -> list:
+    async with model_manager.lease("clip", ClipEmbedder) as clip_embedder:
+        embeddings, failed = await clip_embedder.text2vec_batch(texts, as_numpy=True)
+    return _scatter(embeddings, failed, len(texts), "CLIP text embedding failed")
+
+
+async def _score_images(images: list) -> list:
+    async with model_manager.lease("clip", ClipEmbedder) as clip_embedder:
+        embeddings, failed = await clip_embedder.img2vec_batch(images, as_numpy=True, preprocess_pool=preprocess_pool)
+    scores = []
+    if len(embeddings):
+        async with model_manager.lease("aesthetic", AestheticScorer) as scorer:
+            scores = await executor.run(scorer.score_embeddings, embeddings)
+    return _scatter([float(score) for score in scores], failed, len(images), "CLIP embedding failed")
+
+
+async def _tag_images(items: list) -> list:
+    # One forward for the whole batch at the loosest settings asked for, then each
+    # request keeps its own top `limit` above its own threshold (tags come sorted)
+    images = [image for image, _, _ in items]
+    async with model_manager.lease("tagger", ImageTagger) as tagger:
+        thresholds = [tagger.threshold if threshold is None else threshold for _, _, threshold in items]
+        results, failed = await tagger.predict_batch(
+            images, max(limit for _, limit, _ in items), min(thresholds), preprocess_pool=preprocess_pool
+        )
+    failed = set(failed)
+    return [
+        ValueError("Tagging failed") if i in failed else
+        dict([(tag, score) for tag, score in tags.items() if score >= threshold][:limit])
+        for i, (tags, (_, limit, _), threshold) in enumerate(zip(results, items, thresholds))
+    ]
+
+
+def _batcher(fn) -> MicroBatcher:
+    # The batch coroutines run their forwards on the executor themselves
+    return MicroBatcher(fn, None, SERVE_MAX_BATCH_SIZE, SERVE_MAX_WAIT_MS, SERVE_MAX_QUEUE)
+
+
+batchers = {
+    "clip_image": _batcher(_embed_images),
+    "clip_text": _batcher(_embed_texts),
+    "aesthetic": _batcher(_score_images),
+    "tagger": _batcher(_tag_images),
+}
+for name, batcher in batchers.items():
+    QUEUE_DEPTH.labels(f"{name}_batcher").set_function(lambda batcher=batcher: batcher.queue_depth)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global model_manager, preprocess_pool
+    # ModelManager starts its idle reaper on the running loop
+    model_manager = ModelManager(idle_timeout=int(os.getenv("MODEL_IDLE_TIMEOUT", "300")))
+    preprocess_pool = PreprocessPool()
+    yield
+    for batcher in batchers.values():
+        batcher.close()
+    preprocess_pool.shutdown()
+    await model_manager.clean()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+@app.exception_handler(InferenceSaturated)
+async def inference_saturated(request: Request, exc: InferenceSaturated):
+    return JSONResponse(
+        status_code=503,
+        content={"error": "Inference is saturated, try again later"},
+        headers={"Retry-After": "1"}
+    )
+
+
+async def _submit(name: str, item):
+    try:
+        return await batchers[name].submit(item)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+
+async def _image(request: Request) -> bytes:
+    # Left encoded: the preprocess pool decodes it in a worker process, and an
+    # undecodable body comes back from the batch as a 422
+    body = await request.body()
+    if not body:
+        raise HTTPException(status_code=400, detail="Send the encoded image as the request body")
+    return body
+
+
+def _embedding_response(request: Request, embedding: np.ndarray) -> Response:
+    embedding = np.asarray(embedding, dtype="<f4")
+    if "application/json" in request.headers.get("accept", ""):
+        return JSONResponse({"embedding": embedding.tolist()})
+    return Response(embedding.tobytes(), media_type=FLOAT32, headers={"X-Embedding-Dim": str(embedding.shape[-1])})
+
+
+@app.post("/v1/embed/image")
+async def embed_image(request: Request):
+    return _embedding_response(request, await _submit("clip_image", await _image(request)))
+
+
+@app.post("/v1/embed/text")
+async def embed_text(request: Request):
+    text = (await request.body()).decode("utf-8")
+    if not text:
+        raise HTTPException(status_code=400, detail="Send the text as the request body")
+    return _embedding_response(request, await _submit("clip_text", text))
+
+
+@app.post("/v1/aesthetic")
+async def aesthetic(request: Request):
+    return {"score": await _submit("aesthetic", await _image(request))}
+
+
+@app.post("/v1/tags")
+async def tags(request: Request, limit: int = Query(20, ge=1, le=200), threshold: Optional[float] = Query(None, ge=0, le=1)):
+    return {"tags": await _submit("tagger", (await _image(request), limit, threshold))}
+
+
+@app.get("/health")
+async def health():
+    return {"status": "ok"}
+
+
+@app.get("/stats")
+async def stats():
+    return {
+        "models": model_manager.stats(),
+        "executor_pending": executor.pending,
+        "queues": {name: batcher.queue_depth for name, batcher in batchers.items()},
+    }
+
+
+@app.get("/metrics")
+async def metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Serve the inference models over HTTP or a Unix socket")
+    parser.add_argument("--uds", default=os.getenv("INFERENCE_UDS"), help="Unix socket path; overrides --host/--port")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=int(os.getenv("INFERENCE_PORT", "8001")))
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.uds:
+        uvicorn.run(app, uds=args.uds)
+    else:
+        uvicorn.run(app, host=args.host, port=args.port)
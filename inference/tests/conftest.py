@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The inference modules import each other flat, as when run from inference/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,90 @@
+import json
+import re
+import sys
+import types
+from types import SimpleNamespace
+
+import numpy as np
+
+# pending.py pulls in DeepFace; the clusterer only needs the recognizer's collection
+sys.modules.setdefault("pending", types.SimpleNamespace(CLUSTER_PREFIX="cluster-", FaceRecognizer=object))
+
+from face_clustering import FaceClusterer  # noqa: E402
+
+
+class StubCollection:
+    """In-memory stand-in for the few Collection calls FaceClusterer makes."""
+
+    def __init__(self, fields: list[str]):
+        self.fields = fields
+        self.rows: dict[str, dict] = {}
+
+    def _matching(self, expr: str) -> list[dict]:
+        field, values = re.fullmatch(r"(\w+) in (.*)", expr).groups()
+        values = set(json.loads(values))
+        return [row for row in self.rows.values() if row[field] in values]
+
+    def upsert(self, columns: list):
+        for values in zip(*columns):
+            self.rows[values[0]] = dict(zip(self.fields, values))
+
+    def query(self, expr: str, output_fields: list[str], consistency_level: str = "Bounded"):
+        # Reads that may miss the clusterer's own recent writes are a bug, not a stub detail
+        assert consistency_level == "Strong"
+        return [{field: row[field] for field in output_fields} for row in self._matching(expr)]
+
+    def delete(self, expr: str):
+        for row in self._matching(expr):
+            del self.rows[row["id"]]
+
+    def search(self, data, anns_field, param, limit, output_fields, consistency_level: str = "Bounded"):
+        assert consistency_level == "Strong"
+        results = []
+        for query in data:
+            hits = sorted(
+                (
+                    SimpleNamespace(id=row["id"], score=float(np.dot(query, row[anns_field])), entity=row)
+                    for row in self.rows.values()
+                ),
+                key=lambda hit: -hit.score
+            )
+            results.append(hits[:limit])
+        return results
+
+
+def _clusterer():
+    centroids = StubCollection(["id", "face_embed", "member_count"])
+    faces = StubCollection(["id", "image_id", "cluster_id", "face_embed"])
+    return FaceClusterer(SimpleNamespace(collection=centroids), faces=faces), centroids, faces
+
+
+def _face(axis: int) -> dict:
+    embedding = np.zeros(8, dtype=np.float32)
+    embedding[axis] = 1
+    return {"embedding": embedding.tolist()}
+
+
+def test_reassigning_an_image_does_not_double_count():
+    clusterer, centroids, faces = _clusterer()
+    first = clusterer.assign("a.jpg", [_face(0), _face(1)])
+    clusterer.assign("b.jpg", [_face(0)])
+    second = clusterer.assign("a.jpg", [_face(0), _face(1)])
+
+    assert second == first
+    assert len(faces.rows) == 3
+    counts = {cluster_id: row["member_count"] for cluster_id, row in centroids.rows.items()}
+    assert counts == {first[0]: 2, first[1]: 1}
+    assert np.allclose(centroids.rows[first[0]]["face_embed"], _face(0)["embedding"])
+
+
+def test_reassigning_with_fewer_faces_drops_stale_rows_and_empty_clusters():
+    clusterer, centroids, faces = _clusterer()
+    first = clusterer.assign("a.jpg", [_face(0), _face(1)])
+    clusterer.assign("a.jpg", [_face(0)])
+
+    assert set(faces.rows) == {"a.jpg#0"}
+    assert set(centroids.rows) == {first[0]}
+    assert centroids.rows[first[0]]["member_count"] == 1
+
+    clusterer.assign("a.jpg", [])
+    assert not faces.rows and not centroids.rows
@@ -0,0 +1,111 @@
+import asyncio
+
+from main import ModelManager
+
+MB = 2**20
+
+
+def fake_model(size_mb: int = 1, load_seconds: float = 0.01):
+    # A model class whose loader counts calls and reports its own size
+    class Fake:
+        loads = 0
+
+        def __init__(self):
+            self.resident_bytes = size_mb * MB
+
+        @classmethod
+        async def loader(cls):
+            cls.loads += 1
+            await asyncio.sleep(load_seconds)
+            return cls()
+
+    return Fake
+
+
+def run(test, **kwargs):
+    # ModelManager starts its reaper on the running loop, so build it inside one
+    async def main():
+        manager = ModelManager(**kwargs)
+        try:
+            await test(manager)
+        finally:
+            manager._cleanup_task.cancel()
+    asyncio.run(main())
+
+
+def test_concurrent_leases_share_one_load():
+    model = fake_model(load_seconds=0.05)
+
+    async def test(manager):
+        async def use():
+            async with manager.lease("fake", model) as handle:
+                await asyncio.sleep(0.01)
+                return handle
+
+        handles = await asyncio.gather(*(use() for _ in range(10)))
+        assert model.loads == 1
+        assert all(handle is handles[0] for handle in handles)
+        assert manager.stats()["models"]["fake"]["leases"] == 0
+
+    run(test)
+
+
+def test_reaper_skips_leased_models():
+    model = fake_model()
+
+    async def test(manager):
+        async with manager.lease("fake", model):
+            await asyncio.sleep(0.2)
+            assert "fake" in manager.stats()["models"]
+        await asyncio.sleep(0.2)
+        assert "fake" not in manager.stats()["models"]
+        assert manager.stats()["idle_unloads"] == 1
+
+    run(test, idle_timeout=0.05)
+
+
+def test_unload_waits_for_the_last_lease():
+    model = fake_model()
+
+    async def test(manager):
+        async with manager.lease("fake", model):
+            async with manager.lease("fake", model):
+                await manager.unload("fake")
+            assert "fake" in manager.stats()["models"]
+        assert "fake" not in manager.stats()["models"]
+
+        # Using the model again before the last lease goes cancels the deferred unload
+        async with manager.lease("fake", model):
+            await manager.unload("fake")
+            await manager.load("fake", model)
+        assert "fake" in manager.stats()["models"]
+        assert model.loads == 2
+
+    run(test)
+
+
+def test_budget_evicts_least_recently_used_unleased_first():
+    models = {name: fake_model() for name in "abcde"}
+
+    async def test(manager):
+        async def touch(*names):
+            for name in names:
+                await manager.load(name, models[name])
+                await asyncio.sleep(0.01)
+
+        await touch("a", "b", "c", "a")
+        await touch("d")
+        # b was the least recently used
+        assert sorted(manager.stats()["models"]) == ["a", "c", "d"]
+
+        async with manager.lease("c", models["c"]):
+            await asyncio.sleep(0.01)
+            await touch("a", "d")
+            # c is now the oldest, but leased, so a goes instead
+            await touch("e")
+            assert sorted(manager.stats()["models"]) == ["c", "d", "e"]
+        assert manager.stats()["evictions"] == 2
+        assert manager.stats()["resident_bytes"] == 3 * MB
+        assert [model.loads for model in models.values()] == [1, 1, 1, 1, 1]
+
+    run(test, memory_budget_mb=3)
@@ -0,0 +1,29 @@
+import numpy as np
+
+from main import ImageTagger
+
+
+def _tagger(vocabulary: int) -> ImageTagger:
+    # _select only reads the vocabulary, so skip loading the model
+    tagger = ImageTagger.__new__(ImageTagger)
+    tagger.top_tags = [f"tag{i}" for i in range(vocabulary)]
+    return tagger
+
+
+def test_select_matches_a_full_sort():
+    rng = np.random.default_rng(0)
+    probs = rng.random((4, 500), dtype=np.float32)
+    selected = _tagger(500)._select(probs, limit=10, threshold=0.5)
+    for row, tags in zip(probs, selected):
+        expected = [i for i in np.argsort(-row)[:10] if row[i] >= 0.5]
+        assert list(tags) == [f"tag{i}" for i in expected]
+        assert list(tags.values()) == sorted(tags.values(), reverse=True)
+
+
+def test_select_thresholds_and_clamps_the_limit():
+    probs = np.array([[0.1, 0.9, 0.4], [0.2, 0.3, 0.35]], dtype=np.float32)
+    assert _tagger(3)._select(probs, limit=10, threshold=0.3) == [
+        {"tag1": np.float32(0.9).item(), "tag2": np.float32(0.4).item()},
+        {"tag2": np.float32(0.35).item(), "tag1": np.float32(0.3).item()},
+    ]
+    assert _tagger(3)._select(probs, limit=0, threshold=0) == [{}, {}]